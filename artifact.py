@@ -0,0 +1,434 @@
+import os
+import sys
+import json
+import mmap
+from array import array
+from hashlib import sha1
+from constants import L2K, PROJECTIONS
+
+# Prebuilt dictionary artifact
+# jisho.dic (Shift_JIS text) -> one binary file with the word list and the indices.
+# The file is memory-mapped on load, so the pages are shared between processes
+# and nothing is decoded or rebuilt at start-up.
+
+# Layout:
+#   MAGIC | version (u32) | header size (u32) | header (json) | sections
+# The header records the source file and (offset, size) of every section.
+# Every section starts at a multiple of 8.
+MAGIC = b"JISHOBIN"
+VERSION = 14
+ALIGN = 8
+
+# word ids are stored as array('I')
+ID_TYPE = 'I'
+# trie nodes that are not a word have id -1 (array('i'))
+NODE_TYPE = 'i'
+
+# n-gram index: every substring of these lengths
+NGRAMS = (2, 3)
+
+#%% Build
+
+# Size, mtime and checksum of the source file
+def _source_info(dict_path:str) -> dict:
+    stat = os.stat(dict_path)
+    with open(dict_path, 'rb') as f:
+        checksum = sha1(f.read()).hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": checksum}
+
+# Read the word list from the source file
+def read_source(dict_path:str, encoding:str) -> list:
+    with open(dict_path, 'r', encoding=encoding) as f:
+        file = f.readlines()
+    return [i.strip() for i in file]
+
+# key -> ids, in dictionary order
+# keys: word -> list of keys (each id is added once per key)
+def _group(words:list, key=None, keys=None) -> dict:
+    res = {}
+    for i, word in enumerate(words):
+        for k in ([key(word)] if key != None else keys(word)):
+            if k not in res:
+                res[k] = []
+            res[k].append(i)
+    return res
+
+# Word -> its distinct kana n-grams
+def _ngrams(word:str) -> list:
+    return list({word[i:i+n] for n in NGRAMS for i in range(len(word) - n + 1)})
+
+# Word -> its anagram signature (kana sorted)
+def _signature(word:str) -> str:
+    return "".join(sorted(word))
+
+# Word -> "あ", "ああ", ... for every kana it has (n times: it has at least n)
+def _counts(word:str) -> list:
+    return [c * n for c in set(word) for n in range(1, word.count(c) + 1)]
+
+# Trie over the words, nodes numbered in depth-first order, so the
+# subtree of node n is the nodes n .. ends[n]-1
+#   first:   edges of node n are first[n] .. first[n+1]-1
+#   labels:  kana code of every edge (sorted within a node), one byte each
+#   targets: child node of every edge
+#   ends:    end of the subtree of every node
+#   ids:     word id of every node, -1 if the path to it is not a word
+def _trie(sections:dict, words:list, alphabet:str):
+    table = {c: i + 1 for i, c in enumerate(alphabet)}
+    order = sorted(range(len(words)), key=words.__getitem__)
+    first, labels, targets, ends, ids = [], bytearray(), [], [], []
+
+    # words order[low:high] share their first `depth` kana
+    def node(low:int, high:int, depth:int) -> int:
+        n = len(ids)
+        ids.append(-1)
+        ends.append(0)
+        first.append(len(labels))
+        if low < high and len(words[order[low]]) == depth: # sorted: the prefix itself first
+            ids[n] = order[low]
+            low += 1
+
+        children = []
+        while low < high:
+            c = words[order[low]][depth]
+            j = low
+            while j < high and words[order[j]][depth] == c:
+                j += 1
+            children.append((c, low, j))
+            low = j
+
+        edge = len(labels)
+        labels.extend(table[c] for c, i, j in children)
+        targets.extend([0] * len(children))
+        for k, (c, i, j) in enumerate(children):
+            targets[edge + k] = node(i, j, depth + 1)
+        ends[n] = len(ids)
+        return n
+
+    node(0, len(words), 0)
+    first.append(len(labels))
+    sections["trie.first"] = array(ID_TYPE, first).tobytes()
+    sections["trie.labels"] = bytes(labels)
+    sections["trie.targets"] = array(ID_TYPE, targets).tobytes()
+    sections["trie.ends"] = array(ID_TYPE, ends).tobytes()
+    sections["trie.ids"] = array(NODE_TYPE, ids).tobytes()
+
+# Segmentation lattice: for every word, which spans word[i:j] are words
+# themselves (the word, its prefixes, its suffixes and the inner spans)
+# bit i*width + j-1, stored as a fixed number of bytes per word (8 up to width 8)
+def _lattice(words:list, width:int) -> bytes:
+    size = (width * width + 63) // 64 * 8
+    known = set(words)
+    res = bytearray()
+    for word in words:
+        bits = 0
+        for i in range(len(word)):
+            for j in range(i + 1, len(word) + 1):
+                if word[i:j] in known:
+                    bits |= 1 << (i * width + j - 1)
+        res += bits.to_bytes(size, "little")
+    return bytes(res)
+
+# Kana masks: for every word, bit code-1 for every kana it has
+# stored as a fixed number of bytes per word (a multiple of 8)
+def _masks(words:list, alphabet:str) -> bytes:
+    size = (len(alphabet) + 63) // 64 * 8
+    table = {c: 1 << i for i, c in enumerate(alphabet)}
+    res = bytearray()
+    for word in words:
+        bits = 0
+        for c in set(word):
+            bits |= table[c]
+        res += bits.to_bytes(size, "little")
+    return bytes(res)
+
+# Kana histogram of every position: position -> {kana: number of words}
+def _histograms(words:list, width:int) -> list:
+    res = [{} for i in range(width)]
+    for word in words:
+        for i, c in enumerate(word):
+            res[i][c] = res[i].get(c, 0) + 1
+    return res
+
+# Projection: kana -> symbol, one symbol per set of L2K classes the kana is in
+# (よ is in both e and o, so it gets a symbol of its own in the vowels)
+def _projection(alphabet:str, classes:str) -> dict:
+    signatures = {c: "".join(k for k in classes if c in L2K[k]) for c in alphabet}
+    symbols = sorted(set(signatures.values()))
+    return {c: chr(ord("A") + symbols.index(signatures[c])) for c in alphabet}
+
+# Postings: offsets (len(keys) + 1) followed by the ids, one array
+# The keys go to their own section (json): a list, or for big indices with
+# str keys of at most `width` kana, one str of space-padded keys
+def _postings(sections:dict, name:str, groups:dict, width:int = 0):
+    keys = sorted(groups.keys())
+    offsets = [0]
+    ids = []
+    for k in keys:
+        ids += groups[k]
+        offsets.append(len(ids))
+    sections[name] = array(ID_TYPE, offsets + ids).tobytes()
+    if width:
+        keys = "".join(k.ljust(width) for k in keys)
+    sections[name + ".keys"] = json.dumps(keys, ensure_ascii=False).encode("utf-8")
+
+# Kana matrix: one row of `width` bytes per word, one byte per kana
+# code = 1 + position in the alphabet, 0 past the end of the word
+def _matrix(words:list, alphabet:str, width:int) -> bytes:
+    table = {ord(c): i + 1 for i, c in enumerate(alphabet)}
+    return "".join(i.ljust(width, "\0") for i in words).translate(table).encode("latin-1")
+
+# Word list -> artifact bytes
+def serialize(words:list, source:dict) -> bytes:
+    sections = {}
+
+    sections["words"] = "\n".join(words).encode("utf-8")
+
+    alphabet = "".join(sorted(set("".join(words))))
+    if len(alphabet) > 255:
+        raise ValueError("too many different kana for the kana matrix")
+    width = max(map(len, words))
+    sections["lengths"] = bytes(map(len, words))
+    sections["matrix"] = _matrix(words, alphabet, width)
+
+    _postings(sections, "by_length", _group(words, key=len))
+    _postings(sections, "ngrams", _group(words, keys=_ngrams), width=max(NGRAMS))
+    _trie(sections, words, alphabet)
+    sections["lattice"] = _lattice(words, width)
+    sections["masks"] = _masks(words, alphabet)
+    # word ids in code point order of the words (prefix -> one bisect range)
+    sections["sorted"] = array(ID_TYPE, sorted(range(len(words)), key=words.__getitem__)).tobytes()
+    # word ids in code point order of the reversed words (suffix -> one range)
+    sections["reversed"] = array(ID_TYPE, sorted(range(len(words)), key=lambda x: words[x][::-1])).tobytes()
+    _postings(sections, "anagrams", _group(words, key=_signature), width=width)
+    _postings(sections, "counts", _group(words, keys=_counts))
+    widths = {"ngrams": max(NGRAMS), "anagrams": width}
+
+    # projected word -> ids, and the ids in order of the projected words
+    projections = {}
+    for name, classes in PROJECTIONS.items():
+        projections[name] = _projection(alphabet, classes)
+        table = str.maketrans(projections[name])
+        projected = [i.translate(table) for i in words]
+        _postings(sections, name, _group(projected, key=lambda x: x), width=width)
+        sections[name + ".sorted"] = array(ID_TYPE, sorted(range(len(words)), key=projected.__getitem__)).tobytes()
+        widths[name] = width
+
+    # Section offsets are relative to the end of the header
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        layout[name] = [offset, len(data)]
+        offset += len(data) + (-len(data)) % ALIGN
+
+    header = json.dumps({
+        "source": source,
+        "byteorder": sys.byteorder,
+        "count": len(words),
+        "alphabet": alphabet,
+        "width": width,
+        "ngrams": NGRAMS,
+        "widths": widths,
+        "projections": projections,
+        "histograms": _histograms(words, width),
+        "sections": layout,
+    }, ensure_ascii=False).encode("utf-8")
+    header += b" " * ((-(len(MAGIC) + 8 + len(header))) % ALIGN)
+
+    res = [MAGIC, VERSION.to_bytes(4, "little"), len(header).to_bytes(4, "little"), header]
+    for data in sections.values():
+        res.append(data)
+        res.append(b"\0" * ((-len(data)) % ALIGN))
+    return b"".join(res)
+
+# Build the artifact file from the source file
+# Written to a temporary file first, so readers never see half a file
+def build(dict_path:str, path:str, encoding:str) -> bytes:
+    data = serialize(read_source(dict_path, encoding), _source_info(dict_path))
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+    return data
+
+#%% Load
+
+# key -> ids of one index (memoryviews of the artifact, no copy)
+# keys: list of keys, or one str of space-padded keys of `width` kana
+# (no dict of str for the big indices, a lookup is one str.find)
+class Postings():
+    def __init__(self, keys, data:memoryview, width:int = 0):
+        self.width = width
+        if width:
+            self.keys = keys
+            self.size = len(keys) // width
+        else:
+            self.keys = {k: i for i, k in enumerate(keys)}
+            self.size = len(keys)
+        self.offsets = data[:self.size+1]
+        self.ids = data[self.size+1:]
+
+    # key -> position, -1 if not found
+    def _find(self, key) -> int:
+        if not self.width:
+            return self.keys.get(key, -1)
+        if len(key) > self.width:
+            return -1
+        # the slots are sorted (space sorts before every kana): binary search
+        key = key.ljust(self.width)
+        keys, width = self.keys, self.width
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if keys[mid*width:(mid+1)*width] < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low if low < self.size and keys[low*width:(low+1)*width] == key else -1
+
+    def _ids(self, i:int) -> memoryview:
+        return self.ids[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, key) -> memoryview:
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self._ids(i)
+
+    def __contains__(self, key) -> bool:
+        return self._find(key) != -1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        return default if i == -1 else self._ids(i)
+
+    def items(self):
+        if self.width:
+            for i in range(self.size):
+                yield self.keys[i*self.width:(i+1)*self.width].rstrip(), self._ids(i)
+        else:
+            for k, i in self.keys.items():
+                yield k, self._ids(i)
+
+# Trie of the words (see _trie), read from the artifact without copy
+# The words with a prefix (exact membership: Corpus.word_ids, a dict)
+class Trie():
+    def __init__(self, artifact):
+        self.alphabet = {c: bytes([i + 1]) for i, c in enumerate(artifact.header["alphabet"])}
+        self.first = artifact.section("trie.first").cast(ID_TYPE)
+        self.targets = artifact.section("trie.targets").cast(ID_TYPE)
+        self.ends = artifact.section("trie.ends").cast(ID_TYPE)
+        self.ids = artifact.section("trie.ids").cast(NODE_TYPE)
+        # labels are searched in place (mmap and bytes both have find)
+        self.buffer = artifact.buffer
+        self.labels = artifact.base + artifact.header["sections"]["trie.labels"][0]
+        self.nbytes = sum(artifact.header["sections"][i][1] for i in artifact.header["sections"] if i.startswith("trie."))
+
+    # node, kana -> child node, -1 if there is none
+    def _child(self, node:int, kana:str) -> int:
+        code = self.alphabet.get(kana)
+        if code == None:
+            return -1
+        i = self.buffer.find(code, self.labels + self.first[node], self.labels + self.first[node+1])
+        return -1 if i == -1 else self.targets[i - self.labels]
+
+    # text -> its node, -1 if no word starts with it
+    def node(self, text:str) -> int:
+        node = 0
+        for i in text:
+            node = self._child(node, i)
+            if node == -1:
+                return -1
+        return node
+
+    # ids of the words that start with the prefix, in code point order
+    # (depth-first order of the nodes)
+    def prefix_ids(self, prefix:str) -> list:
+        node = self.node(prefix)
+        if node == -1:
+            return []
+        return [i for i in self.ids[node:self.ends[node]] if i != -1]
+
+class Artifact():
+    # buffer: mmap of the artifact file, or the bytes from serialize
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+        if bytes(self.view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a jisho artifact")
+        pointer = len(MAGIC)
+        self.version = int.from_bytes(self.view[pointer:pointer+4], "little")
+        if self.version != VERSION:
+            raise ValueError(f"artifact version {self.version}, expected {VERSION}")
+        size = int.from_bytes(self.view[pointer+4:pointer+8], "little")
+        pointer += 8
+
+        self.header = json.loads(bytes(self.view[pointer:pointer+size]).decode("utf-8"))
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError("artifact built on a machine with another byte order")
+        self.base = pointer + size
+
+    # Raw bytes of a section (no copy)
+    def section(self, name:str) -> memoryview:
+        offset, size = self.header["sections"][name]
+        return self.view[self.base+offset:self.base+offset+size]
+
+    # Whether the artifact was built from the current source file
+    # mtime first, the checksum only if the file was touched
+    def fresh(self, dict_path:str) -> bool:
+        source = self.header["source"]
+        stat = os.stat(dict_path)
+        if stat.st_size != source["size"]:
+            return False
+        if stat.st_mtime_ns == source["mtime_ns"]:
+            return True
+        return _source_info(dict_path)["sha1"] == source["sha1"]
+
+    # All the words, one per line
+    def text(self) -> str:
+        return str(self.section("words"), "utf-8")
+
+    # Section of word ids
+    def ids(self, name:str) -> memoryview:
+        return self.section(name).cast(ID_TYPE)
+
+    def trie(self) -> Trie:
+        return Trie(self)
+
+    # key -> ids
+    def index(self, name:str) -> Postings:
+        keys = json.loads(str(self.section(name + ".keys"), "utf-8"))
+        width = self.header["widths"].get(name, 0)
+        return Postings(keys, self.section(name).cast(ID_TYPE), width)
+
+# Load the artifact, (re)building it if it is missing, stale or from another version
+# If the file cannot be written, the artifact is kept in memory for this process only
+def load(dict_path:str, path:str, encoding:str) -> Artifact:
+    try:
+        with open(path, 'rb') as f:
+            res = Artifact(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        if res.fresh(dict_path):
+            return res
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        build(dict_path, path, encoding)
+        with open(path, 'rb') as f:
+            return Artifact(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except OSError:
+        return Artifact(serialize(read_source(dict_path, encoding), _source_info(dict_path)))
+
+#%% Offline build: python artifact.py
+
+if __name__ == "__main__":
+    from constants import DICT_PATH, ARTIFACT_PATH, ENCODING
+    data = build(DICT_PATH, ARTIFACT_PATH, ENCODING)
+    print(f"{ARTIFACT_PATH}: {len(data)} bytes")
+    res = Artifact(data)
+    for name, (offset, size) in res.header["sections"].items():
+        print(f"  {name:16} {size:>10} bytes")
+    print(f"  trie total       {res.trie().nbytes:>10} bytes")
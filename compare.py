@@ -0,0 +1,48 @@
+from main import JishoSearcher
+from time import time
+from corpus import bit_ids
+
+# The fast paths against the plain matcher (_nfm), every word of the dictionary
+# - numpy engine over the kana matrix (_matrix_search)
+# - global &, |, ! as bitset algebra (_bits)
+
+# Kana classes: the numpy engine supports them
+MATRIX = ["?[aa]?", "??[k]?", "?[o]*{1-3}", "?[st]?[aa]", "?[k]??[aa]", "*{2-3}[!aa]",
+          "*{1-2}?[k]", "?[st]*{1-2}?[aa]", "?[n]?[n]"]
+
+# Global &, |, !
+ALGEBRA = ["*あ*&*い*", "!*ん*&???", "<あい>*|*ねこ", "?[o]?&!*ん", "??&!?[aa]?",
+           "*[aa]|あ?", "!?[st]*", "?[k]*&*[aa]@", "(*ん|*い)&!??"]
+
+# Query -> its plan, and the words _nfm matches
+def reference(test, query):
+    prepared = test._prepare(test._canonical(test._normalize(query)))
+    assert type(prepared) != str, (query, prepared)
+    plan = prepared[1]
+    test.leaf_matchers = prepared[3] # _bits confirms leaves with them (see _confirm)
+    test.start_time, test.timeout = time(), False
+    words = test.corpus.words
+    return plan, [words[i] for i in range(len(words)) if test._nfm(plan, words[i], i)]
+
+def compare():
+    test = JishoSearcher()
+    engine = test._matrix_engine()
+    if engine == None:
+        print("numpy not installed, matrix engine skipped")
+    else:
+        for query in MATRIX:
+            plan, words = reference(test, query)
+            shapes = test._matrix_shapes(plan)
+            assert shapes != None, query
+            assert test._matrix_search(shapes, 0) == words, query
+            assert test._matrix_search(shapes, 5) == words[:5], query
+            print(f"matrix  {query} {len(words)}")
+
+    for query in ALGEBRA:
+        plan, words = reference(test, query)
+        assert type(plan) == list and plan[0] in ('&', '|', '!'), query
+        assert [test.corpus.words[i] for i in bit_ids(test._bits(plan))] == words, query
+        assert test.search(query, 0) == words, query
+        print(f"algebra {query} {len(words)}")
+
+compare()
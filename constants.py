@@ -1,5 +1,6 @@
 from re import fullmatch as fm
 from configparser import ConfigParser
+from functools import cache
 from time import time
 
 DEBUG = True
@@ -8,6 +9,7 @@ if DEBUG:
 
 DICT_PATH = "jisho.dic"
 ENCODING = "shift_JIS"
+ARTIFACT_PATH = "jisho.bin" # prebuilt from DICT_PATH, see artifact.py
 TRANS = {
     "？": "?",
     "⋆": "*",
@@ -49,6 +51,9 @@ TRANS = {
     "０": "0"
 
 }
+# Full-width ASCII (ＡＢ, ｎｎ, ＝ ...) and the full-width space
+TRANS.update({chr(i + 0xFEE0): chr(i) for i in range(0x21, 0x7F) if chr(i + 0xFEE0) not in TRANS})
+TRANS["\u3000"] = " "
 
 PI = 3.1415927 # 带π
 
@@ -98,39 +103,47 @@ L2K = {
     "q": "ん"
 }
 
+# Projections of a word: every kana replaced by its L2K classes among these
+# vowels: 段 (a/i/u/e/o), consonants: 行 (k/s/t/...), for ROW / COLUMN
+PROJECTIONS = {
+    "vowels": "aiueo",
+    "consonants": "xkstnhmyrwgzdbpq",
+}
+# At most this many projected words (or prefixes) per lookup
+PROJECTION_KEYS = 64
+
 # 20s
 TIME_LIMIT = 20
 
+# Bitsets kept by a corpus (each one is one bit per word)
+INDEX_CACHE_SIZE = 512
+
+# Plans (and their generated matchers) kept by a searcher
+PLAN_CACHE_SIZE = 256
+
+# QAT lookups kept during one search (see JishoSearcher._qat_lookup)
+QAT_MEMO_SIZE = 4096
+
+# QAT join order (see JishoSearcher._qat_plan): words sampled to estimate
+# an expression, and a depth with QAT_REPLAN times the estimated rows per
+# probe (after QAT_REPLAN_PROBES probes) orders the depths after it again
+QAT_SAMPLE = 200
+QAT_REPLAN = 10
+QAT_REPLAN_PROBES = 16
+
+# numpy engine for kana class patterns (matrix_engine.py), if numpy is installed
+USE_NUMPY = True
+
+# Confirm the candidates from the indices one by one when they are
+# less than 1/INDEX_RATIO of the dictionary, scan the whole text otherwise
+INDEX_RATIO = 4
+
 for i in ALLOW:
     TRANS[i] = i
 
-# Read File
-with open(DICT_PATH, 'r', encoding=ENCODING) as f:
-    file = f.readlines()
-dict = [i.strip() for i in file]
-
-# Hash Table
-hasht = {}
-for i in dict:
-    hasht[hash(i)] = i
-
-# Create indices for faster lookup
-dict_by_length = {}
-dict_by_first_char = {}
-for word in dict:
-    # Index by length
-    length = len(word)
-    if length not in dict_by_length:
-        dict_by_length[length] = []
-    dict_by_length[length].append(word)
-    
-    # Index by first character
-    if word:
-        first_char = word[0]
-        if first_char not in dict_by_first_char:
-            dict_by_first_char[first_char] = []
-        dict_by_first_char[first_char].append(word)
-
-# i18n
-config = ConfigParser()
-config.read("./i18n.cfg",encoding="utf-8")
\ No newline at end of file
+# i18n (read on first error message)
+@cache
+def config() -> ConfigParser:
+    res = ConfigParser()
+    res.read("./i18n.cfg",encoding="utf-8")
+    return res
@@ -0,0 +1,380 @@
+import os
+from bisect import bisect_left
+from functools import cached_property
+from constants import DICT_PATH, ARTIFACT_PATH, ENCODING, INDEX_CACHE_SIZE
+import artifact
+
+# Bitset -> ids of the set bits, in increasing (dictionary) order
+# Bitsets are python ints, bit i is the word with id i
+def bit_ids(bits:int):
+    text = bin(bits)[:1:-1]
+    i = text.find('1')
+    while i != -1:
+        yield i
+        i = text.find('1', i + 1)
+
+# The dictionary and its indices
+# Nothing is read until a searcher first needs it, and every index is built
+# on first use only. One Corpus can be shared by several JishoSearchers.
+class Corpus():
+    # artifact_path: prebuilt artifact, next to the dictionary by default
+    def __init__(self, dict_path:str = DICT_PATH, artifact_path:str = None, encoding:str = ENCODING):
+        self.dict_path = dict_path
+        self.encoding = encoding
+        if artifact_path == None:
+            if dict_path == DICT_PATH:
+                artifact_path = ARTIFACT_PATH
+            else:
+                artifact_path = os.path.splitext(dict_path)[0] + ".bin"
+        self.artifact_path = artifact_path
+
+        self._bitsets = {} # index entries built so far, see _cache
+        self._length_texts = {} # see length_text
+        self._projections = {} # see _projected and projection_bits
+
+    # Prebuilt artifact (rebuilt if the dictionary changed)
+    @cached_property
+    def artifact(self):
+        return artifact.load(self.dict_path, self.artifact_path, self.encoding)
+
+    # Whole dictionary as one text, one word per line
+    # (regex scan with ^...$ in MULTILINE mode)
+    @cached_property
+    def text(self) -> str:
+        return self.artifact.text()
+
+    # Word list, in dictionary order (word id = position)
+    @cached_property
+    def words(self) -> list:
+        return self.text.split("\n")
+
+    # Word -> its id: exact membership in one dict lookup
+    # (str hashes change between processes, so this one is not in the artifact)
+    @cached_property
+    def word_ids(self) -> dict:
+        return {word: i for i, word in enumerate(self.words)}
+
+    # Trie of the words: the words with a prefix (see artifact.Trie)
+    @cached_property
+    def trie(self):
+        return self.artifact.trie()
+
+    #%% Sorted words
+    # Word ids in code point order of the words: the words with a prefix
+    # are one bisect range
+
+    @cached_property
+    def sorted_ids(self) -> memoryview:
+        return self.artifact.ids("sorted")
+
+    @cached_property
+    def sorted_words(self) -> list:
+        return list(map(self.words.__getitem__, self.sorted_ids))
+
+    # prefix -> (low, high), the words sorted_ids[low:high] start with it
+    def prefix_range(self, prefix:str):
+        low = bisect_left(self.sorted_words, prefix)
+        return low, bisect_left(self.sorted_words, prefix + chr(0x10ffff), low)
+
+    # The same for the reversed words: a suffix is one bisect range
+
+    @cached_property
+    def reversed_ids(self) -> memoryview:
+        return self.artifact.ids("reversed")
+
+    @cached_property
+    def reversed_words(self) -> list:
+        return [self.words[i][::-1] for i in self.reversed_ids]
+
+    # suffix -> (low, high), the words reversed_ids[low:high] end with it
+    def suffix_range(self, suffix:str):
+        suffix = suffix[::-1]
+        low = bisect_left(self.reversed_words, suffix)
+        return low, bisect_left(self.reversed_words, suffix + chr(0x10ffff), low)
+
+    # suffix -> bitset of the words that end with it
+    def suffix_bits(self, suffix:str) -> int:
+        key = ("suffix", suffix)
+        if key not in self._bitsets:
+            low, high = self.suffix_range(suffix)
+            self._cache(key, self._id_bits(self.reversed_ids[low:high]))
+        return self._bitsets[key]
+
+    # prefix -> bitset of the words that start with it (the subtree of the trie)
+    def prefix_bits(self, prefix:str) -> int:
+        key = ("prefix", prefix)
+        if key not in self._bitsets:
+            self._cache(key, self._id_bits(self.trie.prefix_ids(prefix)))
+        return self._bitsets[key]
+
+    # length -> words
+    @cached_property
+    def by_length(self) -> dict:
+        return self._index("by_length")
+
+    # length -> word ids, in dictionary order
+    @cached_property
+    def ids_by_length(self):
+        return self.artifact.index("by_length")
+
+    # length -> words of that length, one per line
+    # Every line is length + 1 characters, so a match at offset i is word i // (length + 1)
+    def length_text(self, length:int) -> str:
+        if length not in self._length_texts:
+            self._length_texts[length] = "\n".join(self.by_length.get(length, []))
+        return self._length_texts[length]
+
+    # Ids of the words of the given lengths, in dictionary order
+    def length_ids(self, lengths) -> list:
+        ids = []
+        for length in lengths:
+            ids += self.ids_by_length.get(length, [])
+        ids.sort()
+        return ids
+
+    # Postings of the artifact -> words
+    def _index(self, name:str) -> dict:
+        words = self.words
+        return {k: list(map(words.__getitem__, v)) for k, v in self.artifact.index(name).items()}
+
+    #%% Kana matrix
+
+    # Longest word
+    @cached_property
+    def width(self) -> int:
+        return self.artifact.header["width"]
+
+    # kana -> code in the kana matrix (1, 2, ...)
+    @cached_property
+    def codes(self) -> dict:
+        return {c: i + 1 for i, c in enumerate(self.artifact.header["alphabet"])}
+
+    # Length of every word, one byte per word
+    @cached_property
+    def lengths(self) -> memoryview:
+        return self.artifact.section("lengths")
+
+    # words x width, one byte per kana (0 past the end of the word)
+    @cached_property
+    def matrix(self) -> memoryview:
+        return self.artifact.section("matrix")
+
+    # Every word at once
+    @cached_property
+    def all_bits(self) -> int:
+        return (1 << len(self.words)) - 1
+
+    # Bytes with one byte per word -> bitset of the words whose byte is in values
+    def _bits(self, data, values) -> int:
+        table = bytearray(b"0" * 256)
+        for i in values:
+            table[i] = ord("1")
+        return int(bytes(data).translate(table)[::-1], 2)
+
+    #%% Statistics (for the planner)
+
+    # length -> number of words
+    @cached_property
+    def length_counts(self) -> dict:
+        return {k: len(v) for k, v in self.ids_by_length.items()}
+
+    # position -> {kana: number of words with that kana there}
+    @cached_property
+    def histograms(self) -> list:
+        return self.artifact.header["histograms"]
+
+    # position -> number of words that long at least
+    @cached_property
+    def position_counts(self) -> list:
+        return [sum(i.values()) for i in self.histograms]
+
+    # position, kana (None for any) -> fraction of the words long enough
+    # that have one of the kana there
+    def position_fraction(self, position:int, kana) -> float:
+        if kana == None:
+            return 1.0
+        if not 0 <= position < self.width or self.position_counts[position] == 0:
+            return 0.0
+        histogram = self.histograms[position]
+        return sum(histogram.get(i, 0) for i in set(kana)) / self.position_counts[position]
+
+    # kana, n -> fraction of the words with that kana at least n times
+    def count_fraction(self, kana:str, n:int) -> float:
+        return len(self.counts.get(kana * n, ())) / len(self.words)
+
+    #%% Positional index
+    # (position, kana) -> bitset, combined with length -> bitset this gives
+    # the words of a given length with given kana at given positions.
+    # Built on first use, one column of the kana matrix per entry.
+
+    # length -> bitset
+    def length_bits(self, length:int) -> int:
+        key = ("length", length)
+        if key not in self._bitsets:
+            if not 0 < length <= self.width:
+                return 0
+            self._cache(key, self._bits(self.lengths, [length]))
+        return self._bitsets[key]
+
+    # position, kana (one or several, as a str) -> bitset of the words
+    # that have one of the kana at that position
+    # For a class, one pass over the column instead of OR-ing every member
+    def position_bits(self, position:int, kana:str) -> int:
+        key = (position, frozenset(kana))
+        if key not in self._bitsets:
+            if not 0 <= position < self.width:
+                return 0
+            codes = [self.codes[i] for i in key[1] if i in self.codes]
+            self._cache(key, self._bits(self.matrix[position::self.width], codes))
+        return self._bitsets[key]
+
+    #%% N-gram index
+    # kana bigram / trigram -> ids of the words that contain it
+    # (postings in the artifact, turned into a bitset on first use)
+
+    @cached_property
+    def ngrams(self):
+        return self.artifact.index("ngrams")
+
+    # n-gram lengths in the index
+    @cached_property
+    def ngram_lengths(self) -> tuple:
+        return tuple(self.artifact.header["ngrams"])
+
+    # n-gram -> bitset of the words that contain it
+    def gram_bits(self, gram:str) -> int:
+        key = ("gram", gram)
+        if key not in self._bitsets:
+            self._cache(key, self._id_bits(self.ngrams.get(gram, ())))
+        return self._bitsets[key]
+
+    #%% Kana masks
+    # For every word, an int with bit code-1 set for every kana it has
+    # (a word has all the kana of a mask m if word_mask & m == m)
+
+    @cached_property
+    def masks(self) -> list:
+        data = self.artifact.section("masks")
+        size = len(data) // self.artifact.header["count"]
+        return [int.from_bytes(data[i:i+size], "little") for i in range(0, len(data), size)]
+
+    # kana -> mask, kana outside the alphabet get a bit no word has
+    def kana_mask(self, kana) -> int:
+        res = 0
+        for i in kana:
+            res |= 1 << (self.codes.get(i, len(self.codes) + 1) - 1)
+        return res
+
+    #%% Segmentation lattice
+    # For every word, a bitset of the spans word[i:j] that are words:
+    # bit i * width + j-1 (see artifact._lattice)
+
+    @cached_property
+    def lattice(self) -> memoryview:
+        return self.artifact.section("lattice")
+
+    # bytes per word in the lattice
+    @cached_property
+    def lattice_size(self) -> int:
+        return len(self.lattice) // self.artifact.header["count"]
+
+    # word id -> its spans
+    def spans(self, word_id:int) -> int:
+        size = self.lattice_size
+        return int.from_bytes(self.lattice[word_id*size:(word_id+1)*size], "little")
+
+    # spans, start -> ends j (increasing) such that word[start:j] is a word
+    def span_ends(self, spans:int, start:int) -> list:
+        row = spans >> (start * self.width)
+        return [j for j in range(start + 1, self.width + 1) if row >> (j - 1) & 1]
+
+    # spans, end -> starts i (increasing) such that word[i:end] is a word
+    def span_starts(self, spans:int, end:int) -> list:
+        return [i for i in range(end) if spans >> (i * self.width + end - 1) & 1]
+
+    #%% Projections
+    # Every word seen through its vowels or consonants (see artifact._projection):
+    # projected word -> ids, and the ids sorted by projected word for prefixes
+
+    # name -> {kana: symbol}
+    def projection(self, name:str) -> dict:
+        return self.artifact.header["projections"][name]
+
+    # name -> projected words, in the order of the sorted ids
+    def _projected(self, name:str):
+        key = ("projected", name)
+        if key not in self._projections:
+            table = str.maketrans(self.projection(name))
+            ids = self.artifact.ids(name + ".sorted")
+            self._projections[key] = (ids, [self.words[i].translate(table) for i in ids])
+        return self._projections[key]
+
+    # name, projected words -> bitset of the words that project to one of them
+    def projection_bits(self, name:str, keys) -> int:
+        if name not in self._projections:
+            self._projections[name] = self.artifact.index(name)
+        index = self._projections[name]
+        res = 0
+        for i in keys:
+            res |= self._id_bits(index.get(i, ()))
+        return res
+
+    # name, projected prefixes -> bitset of the words whose projection
+    # starts with one of them
+    def projection_prefix_bits(self, name:str, prefixes) -> int:
+        ids, projected = self._projected(name)
+        res = 0
+        for i in prefixes:
+            low = bisect_left(projected, i)
+            high = bisect_left(projected, i + chr(0x10ffff), low)
+            res |= self._id_bits(ids[low:high])
+        return res
+
+    #%% Anagram index
+    # Signature (kana sorted) -> ids of the words made of exactly those kana,
+    # and kana x n -> ids of the words with that kana at least n times
+    # (a kana histogram per word, lengths come from length_bits)
+
+    @cached_property
+    def anagrams(self):
+        return self.artifact.index("anagrams")
+
+    @cached_property
+    def counts(self):
+        return self.artifact.index("counts")
+
+    # kana -> bitset of the words that are a rearrangement of them
+    def anagram_bits(self, kana:str) -> int:
+        key = ("anagram", "".join(sorted(kana)))
+        if key not in self._bitsets:
+            self._cache(key, self._id_bits(self.anagrams.get(key[1], ())))
+        return self._bitsets[key]
+
+    # kana, n -> bitset of the words with that kana at least n times
+    def count_bits(self, kana:str, n:int) -> int:
+        key = ("count", kana, n)
+        if key not in self._bitsets:
+            self._cache(key, self._id_bits(self.counts.get(kana * n, ())))
+        return self._bitsets[key]
+
+    # ids -> bitset
+    def _id_bits(self, ids) -> int:
+        data = bytearray(b"0") * len(self.words)
+        for i in ids:
+            data[i] = ord("1")
+        return int(data[::-1], 2)
+
+    # Bounded cache of bitsets (each one is len(words) bits)
+    def _cache(self, key, bits:int):
+        if len(self._bitsets) >= INDEX_CACHE_SIZE:
+            self._bitsets.clear()
+        self._bitsets[key] = bits
+
+# Corpus shared by the searchers that are not given one
+_default = None
+
+def default_corpus() -> Corpus:
+    global _default
+    if _default == None:
+        _default = Corpus()
+    return _default
@@ -1,14 +1,30 @@
+from re import compile as rc, Pattern, MULTILINE
 from constants import *
+from corpus import Corpus, default_corpus, bit_ids
+from heapq import merge
+from itertools import islice
+from matrix_engine import MatrixEngine
 
 class JishoSearcher():
     #%% Initialization & Other Functions
-    def  __init__(self, lang: str = "en"):
+    # corpus: dictionary to search (shared default one if not given)
+    def  __init__(self, lang: str = "en", corpus: Corpus = None):
         # Language Setup
         self.lang = lang
+        # Dictionary, loaded on first search
+        self.corpus = corpus if corpus != None else default_corpus()
+        # Cache for results
+        self._result_cache = {}
+        self.stats = {"words": 0, "rejected": 0, "hits": 0, "misses": 0} # see search
+        self.factors = {} # compiled regex -> literal factors (see _factors)
+        self._plan_cache = {} # see _prepare
+        self.leaf_matchers = {} # id of a leaf of the current plan -> its matcher, see _prepare
+        # numpy engine over the kana matrix (see _matrix_engine)
+        self._engine = None
 
     # Raise an error message
     def _error(self, text:str, ex:str="") -> str: # ex: explain
-        res = "#" + config[self.lang][text]
+        res = "#" + config()[self.lang][text]
         res += ":" + ex
 
         return res
@@ -22,11 +38,11 @@ class JishoSearcher():
         normalized = []
 
         for c in expr:
+            # Translate using dictionary lookup
+            c = TRANS.get(c, c)
             if c in ' \n':
                 continue
             
-            # Translate using dictionary lookup
-            c = TRANS.get(c, c)
             if c not in ALLOW:
                 return self._error("normalizerange", ex=c)
 
@@ -110,9 +126,29 @@ class JishoSearcher():
         # Remove empty brackets
         return expr.replace("()", "").replace("{}", "").replace("<>", "").replace("[]", "")
         
+    # Normalized expression -> canonical form (the key of the caches)
+    # Parentheses around a whole expression, or directly around another
+    # pair, are dropped: (あ*|*い), ((あ*|*い)) and あ*|*い are one query
+    def _canonical(self, expr: str) -> str:
+        pairs = {} # ( -> its )
+        stack = []
+        for i, c in enumerate(expr):
+            if c == '(':
+                stack.append(i)
+            elif c == ')':
+                pairs[stack.pop()] = i
+
+        drop = set()
+        for i, j in pairs.items():
+            whole = (i == 0 or expr[i-1] == ';') and (j == len(expr) - 1 or expr[j+1] == ';')
+            double = i > 0 and expr[i-1] == '(' and pairs[i-1] == j + 1
+            if whole or double:
+                drop |= {i, j}
+        return "".join(c for i, c in enumerate(expr) if i not in drop)
+
     # Whether the expression is in the dictionary
     def _indict(self, expr: str) -> bool:
-        return hash(expr) in hasht
+        return expr in self.corpus.word_ids
     
     # Permutation of the expression (for <...>) - optimized version
     def _permutation(self, expr: str):
@@ -124,31 +160,48 @@ class JishoSearcher():
         return list(set(''.join(p) for p in permutations(expr)))
     
     #%% Set Operations - optimized versions
+    # Classes are kept sorted: the same query gives the same regex every time
     def _union(self, a: str, b: str) -> str:
-        return ''.join(set(a) | set(b))
+        return ''.join(sorted(set(a) | set(b)))
     
     def _intersection(self, a: str, b: str) -> str:
-        return ''.join(set(a) & set(b))
+        return ''.join(sorted(set(a) & set(b)))
     
     def _complement(self, a: str) -> str:
-        return ''.join(KANA - set(a))
+        return ''.join(sorted(KANA - set(a)))
 
     
     #%% Splitter
     def _splitter_re(self, expr, format):
         length = format[0]
+        index = len(self._splitter_stack) # which part this is
+        start = self._splitter_len - len(expr) # where this part starts in the word
+        is_word = index in self._splitter_words # this part must be a word
+        cut = self._splitter_ranges[index] if length == 0 else None # (min, max) of a regex part
+        part = None if is_word else self._splitter_parts[index] # checked as it is cut
         if len(format) == 1:
             if length > 0 and len(expr) != length: # length not match
                 return
             elif length < 0 and len(expr) < -length:
                 return
+            elif cut != None and (len(expr) < cut[0] or cut[1] != None and len(expr) > cut[1]):
+                return
+            elif is_word and not self._splitter_spans >> (start * self.corpus.width + self._splitter_len - 1) & 1:
+                return
+            elif part != None and not self._nfm(part, expr):
+                return
             else: # length match, recording the answer
                 self._splitter_ans.append(self._splitter_stack + [expr,])
+                self._splitter_done = self._splitter_first
                 return
         else:
             if length > 0:
                 if len(expr) < length:
                     return
+                elif is_word and not self._splitter_spans >> (start * self.corpus.width + start + length - 1) & 1:
+                    return
+                elif part != None and not self._nfm(part, expr[:length]):
+                    return
                 else:
                     self._splitter_stack.append(expr[:length])
                     self._splitter_re(expr[length:], format[1:])
@@ -157,17 +210,48 @@ class JishoSearcher():
             else:
                 # why -length
                 # -> consider the minimum length
-                for i in range(-length, len(expr)+1):
+                # and leave the parts after it their minimum
+                end = len(expr) - self._splitter_rest[index]
+                if is_word: # only the cuts where the part is a word (lattice)
+                    cuts = [j - start for j in self.corpus.span_ends(self._splitter_spans, start) if -length <= j - start <= end]
+                elif cut != None: # regex part: only the lengths it can match
+                    cuts = range(cut[0], end + 1 if cut[1] == None else min(cut[1], end) + 1)
+                else:
+                    cuts = range(-length, end + 1)
+                if len(format) == 2 and index + 1 in self._splitter_words: # the rest must be a word: cut only where it is one
+                    cuts = [j - start for j in self.corpus.span_starts(self._splitter_spans, self._splitter_len) if j - start in cuts]
+                for i in cuts:
+                    if part != None and not self._nfm(part, expr[:i]):
+                        continue
                     self._splitter_stack.append(expr[:i])
                     self._splitter_re(expr[i:], format[1:])
                     self._splitter_stack.pop()
+                    if self._splitter_done:
+                        return
 
     # split the expr according to the format, the length limit is set by format
-    def _splitter(self, expr, format): 
+    # spans: lattice of the word (see Corpus.spans), words: the parts that
+    # must be words, only cut there
+    # ranges: (min, max) length of every regex part (see _compile), None: any
+    # parts: plan of every part to check as it is cut, None: not checked
+    # first: stop at the first split
+    def _splitter(self, expr, format, spans:int = 0, words = (), ranges = None, parts = None, first:bool = False):
         # 2 means length = 2
         # -2 means length >= 2
         self._splitter_stack = []
         self._splitter_ans = []
+        self._splitter_len = len(expr)
+        self._splitter_spans = spans
+        self._splitter_words = words
+        self._splitter_ranges = ranges or [None] * len(format)
+        self._splitter_parts = parts or [None] * len(format)
+        self._splitter_first = first
+        self._splitter_done = False
+        # minimum length of the parts after each part
+        self._splitter_rest = rest = [0] * len(format)
+        for i in range(len(format) - 1, 0, -1):
+            length = format[i]
+            rest[i-1] = rest[i] + (abs(length) if length != 0 or self._splitter_ranges[i] == None else self._splitter_ranges[i][0])
         self._splitter_re(expr, format)
         return self._splitter_ans
     
@@ -365,11 +449,51 @@ class JishoSearcher():
         else: # no @ or QAT letters
             return self._regex(expr)
 
+    # QAT parts, format -> (fullmatch of the template, whether it gives the split)
+    # A letter is a named group, the letter again a backreference:
+    # ABA;|A|=1 -> (?P<A>.{1})(?P<B>.+)(?P=A). Voiced letters and @ are
+    # plain groups, checked by the splits (see _qat_rows); the groups give
+    # the only split when at most one part (or letter) has no fixed length.
+    def _template(self, exprs, format):
+        res = ""
+        named = set()
+        unknowns = set() # parts (or letters) of no fixed length
+        exact = True
+        for i in range(len(exprs)):
+            part, length = exprs[i], format[i]
+            size = f"{{{length}}}" if length > 0 else "+"
+            if part == "@":
+                res += f"(.{{{-length},}})"
+                exact = False
+            elif part[0] in ULETTER:
+                if length <= 0:
+                    unknowns.add(part[0])
+                if len(part) == 2: # voiced or semi-voiced
+                    res += f"(.{size})"
+                    exact = False
+                elif part in named:
+                    res += f"(?P={part})"
+                else:
+                    res += f"(?P<{part}>.{size})"
+                    named.add(part)
+            else: # regex
+                res += f"(?:{part})"
+                low, high = self._length_range(part)
+                if low != high:
+                    unknowns.add(i)
+        return (rc(res).fullmatch, exact and len(unknowns) <= 1)
+
     # Turn the expression into regex tree
     # Permutate <...>
     # and pass it to _atQAT
     # lg: less than, greater than
     def _lg(self, expr:str) -> str:
+        if "<" in expr and "(" not in expr:
+            # <...> of kana, ? and *: one node each, matched by counting
+            res = self._windows(expr)
+            if res != None:
+                return res
+
         if "<" in expr:
 
             # Permutate <>
@@ -419,6 +543,50 @@ class JishoSearcher():
         else:
             return self._atQAT(expr)
 
+    # <...> of kana, ? and * -> ["<", kana, min, max]
+    # a run of min..max kana (max None for no bound) that has every kana
+    # of the bracket, ? is one more kana and * any number of them
+    def _rearrange(self, expr:str):
+        kana = "".join(sorted(i for i in expr if i not in '?*'))
+        low = len(kana) + expr.count('?')
+        return ["<", kana, low, None if '*' in expr else low]
+
+    # Expression with <...> -> ["<", ...] if it is the whole word,
+    # otherwise ["@", parts, format] with the <...> nodes as parts
+    # (fixed length, or at least min with *), split like @ and QAT
+    # None if a bracket has something else than kana, ? and *
+    def _windows(self, expr:str):
+        parts = []
+        format = []
+        i = 0
+        while i < len(expr):
+            if expr[i] == '<':
+                j = expr.find('>', i)
+                if any(c not in KANA and c not in '?*' for c in expr[i+1:j]):
+                    return None
+                node = self._rearrange(expr[i+1:j])
+                parts.append(node)
+                format.append(node[2] if node[3] != None else -node[2])
+                i = j + 1
+            else:
+                j = expr.find('<', i)
+                if j == -1:
+                    j = len(expr)
+                sub = self._atQAT(expr[i:j])
+                if type(sub) == str:
+                    if sub[0] == "#": # Error
+                        return sub
+                    parts.append(sub)
+                    format.append(0)
+                else: # @
+                    parts += sub[1]
+                    format += sub[2]
+                i = j
+
+        if len(parts) == 1:
+            return parts[0]
+        return ["@", parts, format]
+
     # Process global &|! (gb: global boolean)
     # and pass it to _lg
     def _gb(self, expr:str):
@@ -500,14 +668,906 @@ class JishoSearcher():
         return self._gb(expr)
 
     # Process QAT Expression (_atQAT)
+    # and add the template of an @ expression (see _template)
     def _process_qat(self, expr:str):
-        return self._atQAT(expr)
+        res = self._atQAT(expr)
+        if type(res) == list:
+            res.append(self._template(res[1], res[2]))
+        return res
+
+    #%% Plan: compile the regex tree
+
+    # Regex tree -> plan
+    # Same shape as the tree, but the regex leaves are compiled once
+    # so that matching a word does not go through re's string cache
+    def _compile(self, expr):
+        if type(expr) == str:
+            if expr == "@" or expr[:1] in ULETTER: # @ or QAT letter
+                return expr
+            else:
+                res = rc(expr)
+                if len(self.factors) >= INDEX_CACHE_SIZE:
+                    self.factors.clear()
+                self.factors[res] = self._factors(expr)
+                return res
+        elif expr[0] == "@": # and the lengths the regex parts can be cut at (see _splitter)
+            parts = [self._compile(i) for i in expr[1]]
+            return ["@", parts, expr[2], [self._length_range(parts[i]) if expr[2][i] == 0 else None for i in range(len(parts))]]
+        elif expr[0] == "<": # matched by counting, nothing to compile
+            return expr
+        else:
+            return [expr[0], [self._compile(i) for i in expr[1]]]
+
+    # Regex -> (prefix, suffix, infixes): literal kana a word must start with,
+    # end with and contain to match, None if the regex is not parsed
+    # (checked with str methods before the regex, see _nfm)
+    def _factors(self, regex:str):
+        shape = self._shape(regex)
+        if shape == None:
+            return None
+        return self._shape_factors(shape)
+
+    # Shape -> (prefix, suffix, infixes), see _factors
+    def _shape_factors(self, shape):
+        i = 0
+        prefix = ""
+        while i < len(shape) and shape[i][0] != None and len(shape[i][0]) == 1 and shape[i][1] == shape[i][2]:
+            prefix += shape[i][0] * shape[i][1]
+            i += 1
+        j = len(shape)
+        suffix = ""
+        while j > i and shape[j-1][0] != None and len(shape[j-1][0]) == 1 and shape[j-1][1] == shape[j-1][2]:
+            suffix = shape[j-1][0] * shape[j-1][1] + suffix
+            j -= 1
+        return (prefix, suffix, self._literals(shape[i:j]))
+
+    # Plan -> its regex leaves if it is only regex leaves and | of regex leaves
+    # (plain patterns, <...>), None otherwise
+    def _alternatives(self, plan):
+        if type(plan) == Pattern:
+            return [plan]
+        elif type(plan) == list and plan[0] == '|':
+            res = []
+            for i in plan[1]:
+                sub = self._alternatives(i)
+                if sub == None:
+                    return None
+                res += sub
+            return res
+        else: # @, &, !
+            return None
+
+    # Plan -> regex over the dictionary text, or None
+    def _compile_scan(self, plan):
+        res = self._alternatives(plan)
+        if res == None:
+            return None
+        return rc("^(?:" + "|".join("(?:" + i.pattern + ")" for i in res) + ")$", MULTILINE)
     
+    #%% Plan: generated matcher
+    # The plan becomes one Python expression over the word w: regexes bound
+    # to names, literal factors and <...> counts written out, & / | / ! as
+    # and / or / not. It is compiled once, so a word costs no type checks,
+    # no operator dispatch and no recursion (only @ splits still call _nfm).
+
+    # Plan -> function(word, word id) -> bool, the same answer as _nfm(plan, word, word id)
+    def _matcher(self, plan):
+        names = {}
+        source = self._source(plan, names)
+        exec(f"def match(w, i):\n    return {source}", names)
+        return names["match"]
+
+    # value -> name it is bound to in the generated code
+    def _bind(self, names:dict, value) -> str:
+        name = f"_{len(names)}"
+        names[name] = value
+        return name
+
+    # Plan -> Python expression of w and its id i (a bool)
+    def _source(self, plan, names:dict) -> str:
+        if type(plan) == Pattern:
+            res = []
+            factors = self.factors.get(plan)
+            if factors != None:
+                if factors[0]:
+                    res.append(f"w.startswith({factors[0]!r})")
+                if factors[1]:
+                    res.append(f"w.endswith({factors[1]!r})")
+                res += [f"{i!r} in w" for i in factors[2]]
+            res.append(f"{self._bind(names, plan.fullmatch)}(w) is not None")
+            return "(" + " and ".join(res) + ")"
+
+        elif type(plan) == str:
+            if plan == "@":
+                return f"(w in {self._bind(names, self.corpus.word_ids)})"
+            return f"({self._bind(names, rc(plan).fullmatch)}(w) is not None)"
+
+        elif plan[0] == "<":
+            kana, low, high = plan[1:]
+            res = [f"{low} <= len(w)"]
+            if high != None:
+                res.append(f"len(w) <= {high}")
+            res += [f"w.count({i!r}) >= {kana.count(i)}" for i in sorted(set(kana))]
+            return "(" + " and ".join(res) + ")"
+
+        elif plan[0] == "@": # splits: left to _nfm
+            return f"{self._bind(names, lambda w, i, plan=plan: self._nfm(plan, w, i))}(w, i)"
+
+        elif plan[0] == '&':
+            return "(" + " and ".join(self._source(i, names) for i in plan[1]) + ")"
+
+        elif plan[0] == '|':
+            return "(" + " or ".join(self._source(i, names) for i in plan[1]) + ")"
+
+        else: # !
+            return f"(not {self._source(plan[1][0], names)})"
+
+    # Canonical expression -> (regex tree, plan, matcher, leaf matchers), or an error
+    # Kept for the next searches of the same expression
+    def _prepare(self, expr:str):
+        if expr not in self._plan_cache:
+            expr_re = self._process_normal(expr)
+            if DEBUG:
+                print(f"Regex expression normal:{expr_re}")
+            if expr_re[0] == "#": # Error
+                return expr_re
+            plan = self._plan(self._compile(expr_re)) # & and | branches in the cheapest order
+            # and one matcher per leaf, for the set algebra (see _confirm)
+            leaves = {id(i): self._matcher(i) for i in self._leaves(plan)}
+            self._cache_plan(expr, (expr_re, plan, self._matcher(plan), leaves))
+        return self._plan_cache[expr]
+
+    # Plan -> its leaves (below the global &, |, !)
+    def _leaves(self, plan) -> list:
+        if type(plan) == list and plan[0] in ('&', '|', '!'):
+            return [j for i in plan[1] for j in self._leaves(i)]
+        return [plan]
+
+    # Bounded: the oldest plans go first
+    def _cache_plan(self, expr:str, value):
+        if len(self._plan_cache) >= PLAN_CACHE_SIZE:
+            del self._plan_cache[next(iter(self._plan_cache))]
+        self._plan_cache[expr] = value
+
+    #%% Plan: candidates from the corpus indices
+
+    # Regex (from _regex) -> [(kana, min, max), ...]
+    # kana: str of the allowed kana, None for any kana
+    # max: None for no upper bound
+    # None if the regex is not one that _regex produces
+    def _shape(self, regex:str):
+        res = []
+        i = 0
+        while i < len(regex):
+            if regex[i] == '.':
+                kana = None
+                i += 1
+            elif regex[i] == '[':
+                j = regex.find(']', i)
+                kana = regex[i+1:j]
+                if j == -1 or kana == "" or any(c not in KANA for c in kana):
+                    return None
+                i = j + 1
+            elif regex[i] in KANA:
+                kana = regex[i]
+                i += 1
+            else:
+                return None
+
+            low, high = 1, 1
+            if i < len(regex) and regex[i] == '*':
+                low, high = 0, None
+                i += 1
+            elif i < len(regex) and regex[i] == '{':
+                j = regex.find('}', i)
+                if j == -1:
+                    return None
+                bounds = regex[i+1:j].split(',')
+                if any(not (b == "" or b.isdigit()) for b in bounds) or bounds[0] == "" == bounds[-1]:
+                    return None
+                if len(bounds) == 1:
+                    low = high = int(bounds[0])
+                elif len(bounds) == 2:
+                    low = int(bounds[0]) if bounds[0] else 0
+                    high = int(bounds[1]) if bounds[1] else None
+                else:
+                    return None
+                i = j + 1
+
+            res.append((kana, low, high))
+        return res
+
+    # Shape -> bitset of the words of the right length with the right kana
+    # at the fixed positions (from the start and from the end)
+    def _shape_candidates(self, shape):
+        corpus = self.corpus
+
+        # kana classes the projections answer exactly (?[a]?[i]?[u], *{3}[k])
+        projected, complete = self._projection_candidates(shape)
+        if complete:
+            return projected
+
+        # fixed-width tokens at both ends, one entry per kana position
+        head = []
+        i = 0
+        while i < len(shape) and shape[i][1] == shape[i][2]:
+            head += [shape[i][0]] * shape[i][1]
+            i += 1
+        tail = []
+        j = len(shape)
+        while j > i and shape[j-1][1] == shape[j-1][2]:
+            tail = [shape[j-1][0]] * shape[j-1][1] + tail
+            j -= 1
+        if i == len(shape): # one length: the literal end goes to the tail
+            k = len(head)
+            while k > 0 and head[k-1] != None and len(head[k-1]) == 1:
+                k -= 1
+            head, tail = head[:k], head[k:]
+
+        low = sum(i[1] for i in shape)
+        high = corpus.width
+        if all(i[2] != None for i in shape):
+            high = min(high, sum(i[2] for i in shape))
+
+        # literal start or end, whichever has fewer words:
+        # the words under it in the trie, or one range of the reversed words
+        # (see Corpus.prefix_bits and Corpus.suffix_bits)
+        prefix = ""
+        while len(prefix) < len(head) and head[len(prefix)] != None and len(head[len(prefix)]) == 1:
+            prefix += head[len(prefix)]
+        suffix = ""
+        while len(suffix) < len(tail) and tail[-1-len(suffix)] != None and len(tail[-1-len(suffix)]) == 1:
+            suffix = tail[-1-len(suffix)] + suffix
+
+        head_bits = corpus.all_bits
+        side = self._affix(prefix, suffix)
+        if side == "prefix":
+            head_bits = corpus.prefix_bits(prefix)
+            head = [None] * len(prefix) + head[len(prefix):]
+        elif side == "suffix":
+            head_bits = corpus.suffix_bits(suffix)
+            tail = tail[:len(tail)-len(suffix)] + [None] * len(suffix)
+
+        for position, kana in enumerate(head):
+            if kana != None:
+                head_bits &= corpus.position_bits(position, kana)
+
+        res = 0
+        for length in range(max(low, 1), high + 1):
+            bits = corpus.length_bits(length) & head_bits
+            for position, kana in enumerate(tail, length - len(tail)):
+                if kana != None and bits:
+                    bits &= corpus.position_bits(position, kana)
+            res |= bits
+
+        # literal runs between the two ends (no fixed position): n-gram index
+        for literal in self._literals(shape[i:j]):
+            if len(literal) < min(corpus.ngram_lengths):
+                continue
+            n = max(k for k in corpus.ngram_lengths if k <= len(literal))
+            for k in range(len(literal) - n + 1):
+                if res:
+                    res &= corpus.gram_bits(literal[k:k+n])
+
+        if projected != None:
+            res &= projected
+        return res
+
+    # Projection table {kana: symbol}, kana class (None for any) -> the symbols
+    # of the class, None if other kana have the same symbols (not exact)
+    def _symbols(self, table:dict, kana):
+        if kana == None:
+            return set(table.values())
+        res = {table[i] for i in kana if i in table}
+        if any(table[i] in res and i not in kana for i in table):
+            return None
+        return res
+
+    # Shape -> (bitset from the projections or None, whether it is exact)
+    # The fixed positions at the start whose classes are exactly sets of
+    # symbols give projected prefixes (one bisect range each); if they are
+    # every position of a fixed shape, the projected words themselves
+    def _projection_candidates(self, shape):
+        head = []
+        for kana, low, high in shape:
+            if low != high:
+                break
+            head += [kana] * low
+        fixed = len(head) == sum(i[1] for i in shape) and all(i[1] == i[2] for i in shape)
+
+        res = None
+        complete = False
+        for name in PROJECTIONS:
+            table = self.corpus.projection(name)
+            columns = [] # symbols of every position
+            count = 1
+            for kana in head:
+                symbols = self._symbols(table, kana)
+                if symbols == None or count * len(symbols) > PROJECTION_KEYS:
+                    break
+                columns.append(symbols)
+                count *= len(symbols)
+            while columns and columns[-1] == set(table.values()): # any kana, restricts nothing
+                columns.pop()
+            if fixed and len(columns) == len(head):
+                pass
+            elif len(columns) < 2: # one position: the position bitsets are enough
+                continue
+
+            keys = [""]
+            for symbols in columns:
+                keys = [k + i for k in keys for i in sorted(symbols)]
+            if fixed and len(columns) == len(head):
+                bits = self.corpus.projection_bits(name, keys)
+                complete = True
+            else:
+                bits = self.corpus.projection_prefix_bits(name, keys)
+            res = bits if res == None else res & bits
+        return res, complete
+
+    # prefix, suffix -> the one with fewer words ("prefix" or "suffix"),
+    # None if both are empty
+    def _affix(self, prefix:str, suffix:str):
+        if prefix == "" and suffix == "":
+            return None
+        elif suffix == "":
+            return "prefix"
+        elif prefix == "":
+            return "suffix"
+        low, high = self.corpus.prefix_range(prefix)
+        low2, high2 = self.corpus.suffix_range(suffix)
+        return "prefix" if high - low <= high2 - low2 else "suffix"
+
+    # Shape, (min, max) -> (ids, words) to try, in dictionary order:
+    # the words in the length range, or if it has fewer words, the words
+    # with the literal start or end of the shape (and the right length)
+    def _shape_words(self, shape, low:int, high):
+        ids, words = self._range(low, high)
+        if shape == None:
+            return ids, words
+        prefix, suffix, infixes = self._shape_factors(shape)
+        side = self._affix(prefix, suffix)
+        if side == None:
+            return ids, words
+
+        if side == "prefix":
+            start, end = self.corpus.prefix_range(prefix)
+            affix = self.corpus.sorted_ids[start:end]
+        else:
+            start, end = self.corpus.suffix_range(suffix)
+            affix = self.corpus.reversed_ids[start:end]
+        if len(affix) >= len(ids):
+            return ids, words
+        lengths = self.corpus.lengths
+        affix = sorted(i for i in affix if low <= lengths[i] and (high == None or lengths[i] <= high))
+        return affix, list(map(self.corpus.words.__getitem__, affix))
+
+    # Shape -> literal runs (kana that must appear next to each other)
+    def _literals(self, shape) -> list:
+        res = [""]
+        for kana, low, high in shape:
+            if kana != None and len(kana) == 1 and low == high:
+                res[-1] += kana * low
+            elif res[-1] != "":
+                res.append("")
+        return [i for i in res if i != ""]
+
+    # Plan -> bitset of the words that can match it, None for no restriction
+    # This is a superset: the plan still has to confirm every candidate
+    def _candidates(self, plan):
+        if type(plan) == Pattern:
+            shape = self._shape(plan.pattern)
+            return None if shape == None else self._shape_candidates(shape)
+
+        elif type(plan) == str: # @ or QAT letter
+            return None
+
+        elif plan[0] == "<": # exact: the words with the right kana histogram
+            kana, low, high = plan[1:]
+            if low == high == len(kana):
+                return self.corpus.anagram_bits(kana)
+            res = self._range_bits(low, high)
+            if res == None:
+                res = self.corpus.all_bits
+            for i in set(kana):
+                res &= self.corpus.count_bits(i, kana.count(i))
+            return res
+
+        elif plan[0] == "@": # the word is the parts one after the other
+            shape = []
+            kana = "" # kana of the <...> parts
+            for i in plan[1]:
+                if type(i) == Pattern:
+                    sub = self._shape(i.pattern)
+                    if sub == None:
+                        return None
+                    shape += sub
+                elif type(i) == list: # <...>: any kana here, but the word has them
+                    shape.append((None, i[2], i[3]))
+                    kana += i[1]
+                elif i == "@": # a word, at least 2 kana
+                    shape.append((None, 2, None))
+                else: # QAT letter
+                    return None
+            res = self._shape_candidates(shape)
+            for i in set(kana):
+                res &= self.corpus.count_bits(i, kana.count(i))
+            return res
+
+        elif plan[0] == '&':
+            res = None
+            for i in plan[1]:
+                bits = self._candidates(i)
+                if bits != None:
+                    res = bits if res == None else res & bits
+            return res
+
+        elif plan[0] == '|':
+            res = 0
+            for i in plan[1]:
+                bits = self._candidates(i)
+                if bits == None:
+                    return None
+                res |= bits
+            return res
+
+        else: # !
+            return None
+
+    #%% Plan: required kana
+
+    # Plan (or regex tree) -> set of kana every matching word has
+    # literal kana of the regex leaves, <...> kana, substituted QAT letters;
+    # & and @ join the sets, | keeps the common kana
+    def _must(self, plan) -> set:
+        if type(plan) == Pattern or type(plan) == str and plan != "@" and plan[:1] not in ULETTER:
+            shape = self._shape(plan if type(plan) == str else plan.pattern)
+            if shape == None:
+                return set()
+            return {kana for kana, low, high in shape if kana != None and len(kana) == 1 and low > 0}
+
+        elif type(plan) == str: # @ or QAT letter
+            return set()
+
+        elif plan[0] == "<":
+            return set(plan[1])
+
+        elif plan[0] == "@" or plan[0] == '&':
+            res = set()
+            for i in plan[1]:
+                res |= self._must(i)
+            return res
+
+        elif plan[0] == '|':
+            res = None
+            for i in plan[1]:
+                res = self._must(i) if res == None else res & self._must(i)
+            return res
+
+        else: # !
+            return set()
+
+    #%% Plan: length bounds
+
+    # Shape -> (min, max) length, max None for no bound
+    def _shape_range(self, shape):
+        low = sum(i[1] for i in shape)
+        if any(i[2] == None for i in shape):
+            return (low, None)
+        return (low, sum(i[2] for i in shape))
+
+    # Plan -> (min, max) length of the words it can match, max None for no bound
+    # ? is 1, *{m-n} is m..n, @ is at least 2, |X|=n fixes X,
+    # & intersects the ranges and | joins them
+    def _length_range(self, plan):
+        if type(plan) == Pattern or type(plan) == str and plan != "@" and plan[:1] not in ULETTER:
+            shape = self._shape(plan if type(plan) == str else plan.pattern)
+            return (0, None) if shape == None else self._shape_range(shape)
+
+        elif type(plan) == str:
+            if plan == "@":
+                return (2, None)
+            length = self.qat_letters[ord(plan[0])-65] # QAT letter
+            return (length, length) if length > 0 else (1, None)
+
+        elif plan[0] == "<":
+            return (plan[2], plan[3])
+
+        elif plan[0] == "@":
+            low, high = 0, 0
+            for i in plan[1]:
+                sub = self._length_range(i)
+                low += sub[0]
+                high = None if high == None or sub[1] == None else high + sub[1]
+            return (low, high)
+
+        elif plan[0] == '&':
+            low, high = 0, None
+            for i in plan[1]:
+                sub = self._length_range(i)
+                low = max(low, sub[0])
+                if sub[1] != None:
+                    high = sub[1] if high == None else min(high, sub[1])
+            return (low, high)
+
+        elif plan[0] == '|':
+            ranges = [self._length_range(i) for i in plan[1]]
+            low = min(i[0] for i in ranges)
+            if any(i[1] == None for i in ranges):
+                return (low, None)
+            return (low, max(i[1] for i in ranges))
+
+        else: # !
+            return (0, None)
+
+    # QAT expression after substitution (parts, format) -> (min, max) length
+    # format: n > 0 fixed length, -n at least n, 0 regex part
+    def _qat_range(self, expr, format):
+        low, high = 0, 0
+        for part, length in zip(expr, format):
+            if length > 0:
+                sub = (length, length)
+            elif length < 0:
+                sub = (-length, None)
+            else:
+                sub = self._length_range(part)
+            low += sub[0]
+            high = None if high == None or sub[1] == None else high + sub[1]
+        return (low, high)
+
+    # QAT expression after substitution (parts, format) -> its shape,
+    # None if a part is not parsed
+    def _qat_shape(self, expr, format):
+        res = []
+        for part, length in zip(expr, format):
+            if part == "@":
+                res.append((None, 2, None))
+            elif part[0] in ULETTER: # not known yet
+                res.append((None, length, length) if length > 0 else (None, -length, None))
+            else: # regex, or the kana of a known letter
+                sub = self._shape(part)
+                if sub == None:
+                    return None
+                res += sub
+        return res
+
+    # (min, max) -> the lengths of the corpus in the range,
+    # None if that is every length
+    def _lengths(self, low:int, high):
+        lengths = [i for i in self.corpus.ids_by_length.keys if low <= i and (high == None or i <= high)]
+        if len(lengths) == len(self.corpus.ids_by_length):
+            return None
+        return lengths
+
+    # (min, max) -> bitset of the words in the range, None for every word
+    def _range_bits(self, low:int, high):
+        lengths = self._lengths(low, high)
+        if lengths == None:
+            return None
+        res = 0
+        for i in lengths:
+            res |= self.corpus.length_bits(i)
+        return res
+
+    # (min, max) -> (ids, words) in the range, in dictionary order
+    # Kept until the next search (QAT asks for the same ranges at every depth)
+    def _range(self, low:int, high):
+        lengths = self._lengths(low, high)
+        if lengths == None:
+            return range(len(self.corpus.words)), self.corpus.words
+        key = tuple(lengths)
+        if key not in self.range_words:
+            ids = self.corpus.length_ids(lengths)
+            self.range_words[key] = (ids, list(map(self.corpus.words.__getitem__, ids)))
+        return self.range_words[key]
+
+    def _range_ids(self, low:int, high):
+        return self._range(low, high)[0]
+
+    #%% Plan: cost model
+    # Every subtree gets (selectivity, cost): the estimated fraction of the
+    # words it matches, and the work to check one word (a regex call is 1).
+    # Estimates come from the length counts and the kana histograms of
+    # every position, with the positions taken as independent.
+
+    # Shape -> estimated fraction of the words it matches
+    def _shape_selectivity(self, shape) -> float:
+        corpus = self.corpus
+        head = []
+        i = 0
+        while i < len(shape) and shape[i][1] == shape[i][2]:
+            head += [shape[i][0]] * shape[i][1]
+            i += 1
+        tail = []
+        j = len(shape)
+        while j > i and shape[j-1][1] == shape[j-1][2]:
+            tail = [shape[j-1][0]] * shape[j-1][1] + tail
+            j -= 1
+        literals = "".join(self._literals(shape[i:j]))
+
+        low, high = self._shape_range(shape)
+        res = 0.0
+        for length, count in corpus.length_counts.items():
+            if length < low or (high != None and length > high):
+                continue
+            p = count / len(corpus.words)
+            for position, kana in enumerate(head):
+                p *= corpus.position_fraction(position, kana)
+            for position, kana in enumerate(tail, length - len(tail)):
+                p *= corpus.position_fraction(position, kana)
+            for kana in literals: # somewhere in between
+                p *= corpus.count_fraction(kana, 1)
+            res += p
+        return res
+
+    # Plan -> (selectivity, cost)
+    def _estimate(self, plan):
+        if type(plan) == Pattern:
+            shape = self._shape(plan.pattern)
+            return (0.5 if shape == None else self._shape_selectivity(shape), 1.0)
+
+        elif type(plan) == str: # @: every word is a word
+            return (1.0, 1.0)
+
+        elif plan[0] == "<":
+            res = 1.0
+            kana, low, high = plan[1:]
+            for i in set(kana):
+                res *= self.corpus.count_fraction(i, kana.count(i))
+            res *= sum(j for i, j in self.corpus.length_counts.items() if low <= i and (high == None or i <= high)) / len(self.corpus.words)
+            return (res, 1.0)
+
+        elif plan[0] == "@": # one regex-like check per part and split
+            shape = []
+            res = 1.0
+            for i in plan[1]:
+                if type(i) == Pattern:
+                    shape += self._shape(i.pattern) or [(None, 0, None)]
+                elif type(i) == list: # <...>
+                    shape.append((None, i[2], i[3]))
+                    res *= self._estimate(["<", i[1], 0, None])[0]
+                else:
+                    shape.append((None, 2, None))
+            return (res * self._shape_selectivity(shape), 4.0 * len(plan[1]))
+
+        elif plan[0] == '&': # the next branch only sees what the previous ones kept
+            selectivity, cost = 1.0, 0.0
+            for i in plan[1]:
+                sub = self._estimate(i)
+                cost += selectivity * sub[1]
+                selectivity *= sub[0]
+            return (selectivity, cost)
+
+        elif plan[0] == '|': # the next branch only sees what the previous ones missed
+            miss, cost = 1.0, 0.0
+            for i in plan[1]:
+                sub = self._estimate(i)
+                cost += miss * sub[1]
+                miss *= 1 - sub[0]
+            return (1 - miss, cost)
+
+        else: # !
+            sub = self._estimate(plan[1][0])
+            return (1 - sub[0], sub[1])
+
+    # Plan -> the same plan with the branches of every & and | reordered:
+    # & cheapest and most selective first (cost / fraction rejected),
+    # | cheapest and most likely first (cost / fraction matched)
+    def _plan(self, plan):
+        if type(plan) != list or plan[0] in ("@", "<"):
+            return plan
+        branches = [self._plan(i) for i in plan[1]]
+        if plan[0] == '&':
+            branches.sort(key=lambda x: self._rank(x, False))
+        elif plan[0] == '|':
+            branches.sort(key=lambda x: self._rank(x, True))
+        return [plan[0], branches]
+
+    # Plan, whether it is a | branch -> order key (smaller first)
+    def _rank(self, plan, matched:bool) -> float:
+        selectivity, cost = self._estimate(plan)
+        useful = selectivity if matched else 1 - selectivity
+        return cost / useful if useful > 0 else float("inf")
+
+    # Plan -> lines describing it, one node per line
+    def _explain(self, plan, depth:int = 0) -> list:
+        selectivity, cost = self._estimate(plan)
+        if type(plan) == Pattern:
+            name = plan.pattern
+        elif type(plan) == str:
+            name = plan
+        elif plan[0] == "<":
+            name = f"<{plan[1]}> {plan[2]}-{'' if plan[3] == None else plan[3]}"
+        elif plan[0] == "@":
+            name = "@ " + " ".join(i.pattern if type(i) == Pattern else i if type(i) == str else f"<{i[1]}>" for i in plan[1])
+        else:
+            name = plan[0]
+        res = [f"{'  ' * depth}{name}  (selectivity {selectivity:.4f}, cost {cost:.2f})"]
+        if type(plan) == list and plan[0] in ('&', '|', '!'):
+            for i in plan[1]:
+                res += self._explain(i, depth + 1)
+        return res
+
+    # Expression -> the plan the search would run, as text:
+    # the tree in evaluation order with the estimates, "#..." on error
+    # (for QAT, the expressions in join order with their rows per probe)
+    def explain(self, expr:str) -> str:
+        if expr == "":
+            return self._error("empty")
+        expr = self._normalize(expr)
+        if expr[0] == '#': # ERR
+            return expr
+        if any(i in ULETTER or i == ';' for i in expr): # QAT: the join order
+            self._setup_qat()
+            error = self._prepare_qat(self._canonical(expr))
+            if error != None:
+                return error
+            self._qat_plan()
+            return "\n".join(self._qat_report())
+        prepared = self._prepare(self._canonical(expr))
+        if type(prepared) == str: # Error
+            return prepared
+        return "\n".join(self._explain(prepared[1]))
+
+    #%% Matrix engine (numpy, optional)
+
+    # Engine over the kana matrix of the corpus, None without numpy
+    def _matrix_engine(self):
+        if not USE_NUMPY or not MatrixEngine.available():
+            return None
+        if self._engine == None or self._engine.corpus is not self.corpus:
+            self._engine = MatrixEngine(self.corpus)
+        return self._engine
+
+    # Plan -> shapes of its leaves if the engine supports all of them, None otherwise
+    def _matrix_shapes(self, plan):
+        leaves = self._alternatives(plan)
+        engine = self._matrix_engine()
+        if leaves == None or engine == None:
+            return None
+
+        res = []
+        for i in leaves:
+            shape = self._shape(i.pattern)
+            if engine.supports(shape) == None:
+                return None
+            res.append(shape)
+        return res
+
+    # Words matching any of the shapes, dictionary order
+    def _matrix_search(self, shapes, num:int):
+        words = self.corpus.words
+        return [words[i] for i in self._matrix_engine().search(shapes, num)]
+
+    #%% Set algebra: global &, |, ! over bitsets
+
+    # Plan -> bitset of the words it matches
+    # within: bitset the result will be ANDed with (None: every word), the
+    # result is only exact inside it, so & passes what is left to the next branch
+    # & is AND, | is OR, ! is NOT, each leaf is evaluated on its own (_leaf_bits)
+    def _bits(self, plan, within = None) -> int:
+        if type(plan) == list and plan[0] == '&':
+            res = within
+            for i in plan[1]:
+                bits = self._bits(i, res)
+                res = bits if res == None else res & bits
+            return res
+
+        elif type(plan) == list and plan[0] == '|':
+            res = 0
+            for i in plan[1]:
+                res |= self._bits(i, within)
+            return res
+
+        elif type(plan) == list and plan[0] == '!':
+            return self.corpus.all_bits ^ self._bits(plan[1][0], within)
+
+        else:
+            return self._leaf_bits(plan, within)
+
+    # Leaf (regex, <...>, @) -> bitset of the words it matches (inside within),
+    # with whatever suits it: the indices alone when they are exact, the few
+    # candidates one by one, the numpy engine, or the regex scan
+    def _leaf_bits(self, plan, within = None) -> int:
+        candidates = self._candidates(plan)
+        if candidates == None:
+            candidates = self.corpus.all_bits
+        low, high = self._length_range(plan)
+        if self._range_bits(low, high) != None:
+            candidates &= self._range_bits(low, high)
+        if within != None:
+            candidates &= within
+
+        if self._exact(plan):
+            return candidates
+        if candidates.bit_count() * INDEX_RATIO < len(self.corpus.words):
+            return self._confirm(plan, candidates)
+
+        shapes = self._matrix_shapes(plan)
+        if shapes != None:
+            return self.corpus._id_bits(self._matrix_engine().search(shapes, 0))
+
+        scan = self._compile_scan(plan)
+        if scan != None:
+            lengths = self._lengths(low, high)
+            if lengths == None:
+                lengths = self.corpus.ids_by_length.keys
+            return self.corpus._id_bits(i for length in lengths for i, word in self._scan_length(scan, length))
+
+        return self._confirm(plan, candidates)
+
+    # Whether the candidates of a leaf are exactly its words
+    # (fixed-width shape: every position checked, <...>: kana counted)
+    def _exact(self, plan) -> bool:
+        if type(plan) == Pattern:
+            shape = self._shape(plan.pattern)
+            return shape != None and all(i[1] == i[2] for i in shape)
+        return type(plan) == list and plan[0] == "<"
+
+    # Plan, candidates -> bitset of the candidates it matches (word by word)
+    def _confirm(self, plan, candidates:int) -> int:
+        words = self.corpus.words
+        masks = self.corpus.masks
+        must = self.corpus.kana_mask(self._must(plan))
+        match = self.leaf_matchers.get(id(plan)) or self._matcher(plan) # made with the plan (see _prepare)
+        res = []
+        for i in bit_ids(candidates):
+            self.stats["words"] += 1
+            if masks[i] & must != must: # a kana is missing
+                self.stats["rejected"] += 1
+            elif match(words[i], i):
+                res.append(i)
+            if time() - self.start_time > TIME_LIMIT: # timeout
+                self.timeout = True
+                break
+        return self.corpus._id_bits(res)
+
+    #%% Scan: whole dictionary
+
+    # Matches of the scan regex in the words of one length, as (id, word)
+    def _scan_length(self, pattern, length:int):
+        ids = self.corpus.ids_by_length.get(length, [])
+        for match in pattern.finditer(self.corpus.length_text(length)):
+            yield ids[match.start() // (length + 1)], match.group()
+
+    # Run the scan regex over the dictionary text, results in dictionary order
+    # The loop over the words stays in C, we only wake up for matches
+    # With a length range, only the texts of those lengths are scanned
+    # (merged back into dictionary order)
+    def _scan(self, pattern, num:int, lengths = None):
+        res = []
+        start_time = time()
+        if lengths == None:
+            matches = (match.group() for match in pattern.finditer(self.corpus.text))
+        else:
+            matches = (word for i, word in merge(*[self._scan_length(pattern, i) for i in lengths]))
+
+        for word in matches:
+            res.append(word)
+            if len(res) == num:
+                break
+
+            if time() - start_time > TIME_LIMIT: # timeout
+                return self._error("timeout")
+
+        return res
+
     #%% Match: Normal
 
     # normal full match
-    def _nfm(self, expr, word):
-        if type(expr) == str:
+    # expr: plan (from _compile) or regex tree
+    # word_id: id of the word if it is a dictionary word (for its lattice)
+    def _nfm(self, expr, word, word_id:int = None):
+        if type(expr) == Pattern: # compiled regex
+            factors = self.factors.get(expr)
+            if factors != None: # literal prefix, suffix, infixes first
+                if not word.startswith(factors[0]) or not word.endswith(factors[1]):
+                    return False
+                for i in factors[2]:
+                    if i not in word:
+                        return False
+            return expr.fullmatch(word) != None
+        elif type(expr) == str:
             if expr == "@": # @
                 return self._indict(word)
                 
@@ -518,34 +1578,46 @@ class JishoSearcher():
             exprs = expr[1] # a list of expressions
             if opt == '&':
                 for i in exprs:
-                    if self._nfm(i, word) == False:
+                    if self._nfm(i, word, word_id) == False:
                         return False
                 return True
             elif opt == '|':
                 for i in exprs:
-                    if self._nfm(i, word) == True:
+                    if self._nfm(i, word, word_id) == True:
                         return True
                 return False
             elif opt == '!':
-                return not self._nfm(exprs[0], word)
+                return not self._nfm(exprs[0], word, word_id)
+            elif opt == "<":
+                return self._window(expr, word)
             elif opt == "@":
                 # Split the word according to the format
+                # @ parts only where the lattice of the word has a word
                 format = expr[2]
-                split = self._splitter(word, format)
-                if split == []:
-                    return False
-                
-                # Try all the cases
-                for case in split:
-                    flag = True
-                    for j in range(len(case)):
-                        temp = self._nfm(exprs[j], case[j])
-                        flag &= temp
-
-                    if flag:
-                        return True
-                    
+                words = [j for j in range(len(exprs)) if type(exprs[j]) == str and exprs[j] == "@"]
+                spans = self._word_spans(word, word_id) if words else None
+                if spans == None:
+                    words = ()
+                # the other parts checked as they are cut, up to the first split
+                return self._splitter(word, format, spans, words, expr[3], exprs, True) != []
+
+    # Word (and its id if the caller has it) -> its segmentation lattice,
+    # None if it is not in the dictionary
+    def _word_spans(self, word:str, word_id:int = None):
+        if word_id == None:
+            word_id = self.corpus.word_ids.get(word)
+        return None if word_id == None else self.corpus.spans(word_id)
+
+    # <...> node, text -> whether the text is a rearrangement of it
+    # (right length, every kana of the bracket at least as many times)
+    def _window(self, node, text:str) -> bool:
+        kana, low, high = node[1:]
+        if len(text) < low or (high != None and len(text) > high):
+            return False
+        for i in set(kana):
+            if text.count(i) < kana.count(i):
                 return False
+        return True
 
     #%% Match: QAT QAQ
     
@@ -589,7 +1661,22 @@ class JishoSearcher():
     # Set up QAT QAQ
     def _setup_qat(self):
         self.qat_exprs = [] # Expressions (["@",,] or "")
+        self.qat_plans = [] # Compiled expressions (same order as qat_exprs)
+        self.qat_matchers = [] # Generated matchers of the normal expressions
+        self.qat_words = [] # (ids, words) of the right length for the normal expressions
+        self.qat_masks = [] # kana masks of the normal expressions
+        self.range_words = {} # see _range
+        self.qat_word_letters = set() # letters that are a whole expression
         self.qat_letters = [0 for i in range(26)] # length limit
+        self.qat_texts = [] # the expressions as written
+        self.qat_join = [] # expressions in join order (see _qat_plan)
+        self.qat_keys = []
+        self.qat_new = []
+        self.qat_index = {}
+        self.qat_lookup = []
+        self.qat_expected = []
+        self.qat_fanouts = []
+        self.qat_memo = {} # (expression, values of its bound letters) -> rows, see _qat_lookup
 
         self.qat_current_letters = ['' for i in range(26)] # current letters
         self.qat_current_answer = [] # current answer
@@ -603,12 +1690,349 @@ class JishoSearcher():
         
         self.qat_progress = [] # Progress of QAT
 
-    # QAT (dfs)
+    # Canonical QAT expression -> its expressions, letters and plans set on
+    # the searcher (a "#..." error is returned), kept for the next searches
+    def _prepare_qat(self, expr:str):
+        key = expr
+        if key in self._plan_cache:
+            (self.qat_letters, self.qat_exprs, self.qat_texts, self.qat_word_letters,
+             self.qat_plans, self.qat_matchers, self.qat_words, self.qat_masks) = self._plan_cache[key]
+            return None
+
+        # Reject <>
+        if "<" in expr or ">" in expr:
+            return self._error("syntax", ex="< or > in QAT")
+
+        exprs = expr.split(";")
+
+        self.qat_letters = [0 for i in range(26)]
+
+        for i in range(len(exprs)-1, -1, -1):
+            if exprs[i] == "": # Delete Empty Expressions
+                del exprs[i]
+            else:
+                while exprs[i][0] == '(' and exprs[i][-1] == ')': # Remove unnecessary ()
+                    exprs[i] = exprs[i][1:-1]
+                # Register Existed Letters
+                # 0 : not exist, -1 : exist
+                for j in range(26):
+                    if chr(j+65) in exprs[i]:
+                        self.qat_letters[j] = -1
+
+        if exprs == []: # check if empty
+            return self._error("empty")
+
+        # Find Length Limitation - optimized
+        for i in range(len(exprs) - 1, -1, -1):
+            if '=' in exprs[i]:  # Fixed Length
+                condition = exprs[i].split('=')
+                # Validate format more efficiently
+                if (len(condition) != 2 or not condition[1].isdigit() or 
+                    len(condition[0]) != 3 or not condition[0].startswith('|') or 
+                    not condition[0].endswith('|')):
+                    return self._error("syntax", ex=exprs[i])
+                
+                letter_idx = ord(condition[0][1]) - ord('A')
+                length_val = int(condition[1])
+                
+                # Check validity
+                if not (0 <= letter_idx < 26) or not (0 < length_val < 10):
+                    return self._error("syntax", ex=exprs[i])
+
+                if self.qat_letters[letter_idx] != -1:  # already defined
+                    return self._error("syntax", ex=exprs[i])
+
+                self.qat_letters[letter_idx] = length_val
+                del exprs[i]  # Remove the expression
+        
+        if exprs == []: # check if empty
+            return self._error("empty")
+        
+        # reject global &|! - optimized check
+        for expr in exprs:
+            bracket_level = 0
+            for char in expr:
+                if char in '([':
+                    bracket_level += 1
+                elif char in ')]':
+                    bracket_level -= 1
+                elif bracket_level == 0 and char in '&|!':
+                    return self._error("syntax", ex=expr)
+        
+        # In the order of the query: the solver orders them (see _qat_plan)
+        self.qat_exprs = [self._process_qat(i) for i in exprs]
+        self.qat_texts = exprs
+        self.qat_word_letters = {i for i in exprs if i in ULETTER}
+
+        for i in self.qat_exprs:
+            if i[0] == "#": # Error
+                return i
+
+        # Compile the expressions once: normal ones are matched word by word,
+        # the regex parts of @ ones split by split (see _qat_rows)
+        self.qat_plans = [self._compile(i) for i in self.qat_exprs]
+        self.qat_matchers = [self._matcher(p) if type(e) == str else None for e, p in zip(self.qat_exprs, self.qat_plans)]
+        self.qat_words = [self._shape_words(self._shape(e), *self._length_range(p)) if type(e) == str else None for e, p in zip(self.qat_exprs, self.qat_plans)]
+        self.qat_masks = [self.corpus.kana_mask(self._must(p)) if type(e) == str else None for e, p in zip(self.qat_exprs, self.qat_plans)]
+
+        self._cache_plan(key, (self.qat_letters, self.qat_exprs, self.qat_texts, self.qat_word_letters,
+                               self.qat_plans, self.qat_matchers, self.qat_words, self.qat_masks))
+        return None
+
+    # QAT as relational join
+    # Every expression gives a table: one row (word, values of its letters)
+    # for every way a word splits along it, letters unbound. The tables are
+    # then joined on the letters they share, smallest table first: the first
+    # one is read as it is made, the others are probed through a hash index
+    # on the letters bound before them, built on the first probe.
+    # A table whose start or end is a bound letter is not built at all: each
+    # probe looks up its own words, with the value of the letter as the
+    # literal start or end (sorted and reversed words, lengths).
+    # Voicing is a transform of the join key: a row keeps the plain value
+    # of a letter (the un-voiced kana of A"), so A and A" rows join.
+
+    # Expression (index) -> its letters, in order of first appearance
+    def _qat_letters(self, index:int) -> list:
+        exprssion = self.qat_exprs[index]
+        if type(exprssion) == str: # normal expression
+            return []
+        res = []
+        for part in exprssion[1]:
+            if part[0] in ULETTER and part[0] not in res:
+                res.append(part[0])
+        return res
+
+    # Expression (index), values of the letters bound so far -> its parts and
+    # format with those letters written out, None if a voicing fails
+    def _qat_bind(self, index:int, bound:dict):
+        expr, format = self.qat_exprs[index][1][:], self.qat_exprs[index][2][:]
+        for i in range(len(expr)):
+            if expr[i][0] in bound:
+                value = bound[expr[i][0]]
+                if expr[i][-1] == '"': # voice
+                    value = self._voice(value)
+                elif expr[i][-1] == '\'': # semi-voice
+                    value = self._semi_voice(value)
+                if value == "#": # ERROR
+                    return None
+                expr[i] = value
+                format[i] = len(value)
+        return expr, format
+
+    # Expression (index) -> (ids, words) its table is made of
+    # (parts, format): the expression with bound letters written out
+    def _qat_candidates(self, index:int, bound_expr = None):
+        exprssion = self.qat_exprs[index]
+        if type(exprssion) == str: # normal expression
+            return self.qat_words[index] # only the lengths the expression allows
+        expr, format = bound_expr if bound_expr != None else exprssion[1:3]
+        # only the lengths the parts can add up to,
+        # and the literal start or end if it has fewer words
+        return self._shape_words(self._qat_shape(expr, format), *self._qat_range(expr, format))
+
+    # Expression (index) -> its table: (word, values of its letters) for
+    # every split of every word, in dictionary order (a generator)
+    # bound: values of letters, only the rows with them
+    # candidates: (ids, words) to read instead (a sample, see _qat_estimate)
+    # progress: show a bar if debug (the depth-0 table only, see _qat)
+    def _qat_rows(self, index:int, bound:dict = None, candidates = None, progress:bool = False):
+        exprssion = self.qat_exprs[index]
+        masks = self.corpus.masks
+        bound_expr = self._qat_bind(index, bound) if bound else None
+        if bound and bound_expr == None: # cannot be voiced
+            return
+        ids, words = candidates if candidates != None else self._qat_candidates(index, bound_expr)
+
+        if type(exprssion) == str: # normal expression
+            match = self.qat_matchers[index]
+            must = self.qat_masks[index]
+            for i in range(len(words)):
+                self.stats["words"] += 1
+                if masks[ids[i]] & must != must: # a kana is missing
+                    self.stats["rejected"] += 1
+                elif match(words[i], ids[i]):
+                    yield (words[i], ())
+            return
+
+        expr, format = exprssion[1], exprssion[2]
+        if len(expr) == 1 and expr[0] in ULETTER and not bound: # a letter alone: every word, no split
+            self.stats["words"] += len(words)
+            for word in words:
+                yield (word, (word,))
+            return
+
+        letters = self._qat_letters(index)
+        parts = [i for i in range(len(expr)) if expr[i][0] in ULETTER] # QAT letters
+        regex = [i for i in range(len(expr)) if format[i] == 0] # the splits still have to match them
+        ranges = self.qat_plans[index][3] # see _compile
+        checks = [self.qat_plans[index][1][i] if i in regex else None for i in range(len(expr))] # compiled regex parts
+        template, exact = exprssion[3] # see _template
+        bound = bound or {}
+        must = self._must(exprssion)
+        if bound: # bound letters: cut at their length, and their kana are needed
+            must = self._must(["@", *bound_expr])
+            format = bound_expr[1]
+
+        # Parts that must be words: @, and the letters that are
+        # a whole expression somewhere (cut only there, see _splitter)
+        at = [i for i in range(len(expr)) if expr[i] == "@" or expr[i] in self.qat_word_letters]
+
+        # the kana of the literals
+        must = self.corpus.kana_mask(must)
+        if DEBUG and progress:
+            iterate = tqdm.trange(len(words))
+        else:
+            iterate = range(len(words))
+
+        for i in iterate:
+            self.stats["words"] += 1
+            if masks[ids[i]] & must != must: # a kana is missing
+                self.stats["rejected"] += 1
+                continue
+            word = words[i]
+            found = template(word)
+            if found == None: # no split can match
+                continue
+            if exact: # the only split: the groups
+                values = dict(bound) if bound else {}
+                groups = found.groupdict()
+                if all(values.setdefault(j, groups[j]) == groups[j] for j in letters):
+                    yield (word, tuple(values[j] for j in letters))
+                continue
+
+            for case in self._splitter(word, format, self.corpus.spans(ids[i]) if at else 0, at, ranges, checks):
+                # Plain value of every letter, the same at every place
+                values = dict(bound) if bound else {}
+                for j in parts:
+                    if expr[j][-1] == '"': # un-voice
+                        value = self._un_voice(case[j])
+                    elif expr[j][-1] == '\'': # un-semi-voice
+                        value = self._un_semi_voice(case[j])
+                    else:
+                        value = case[j]
+                    if value == "#" or values.setdefault(expr[j][0], value) != value:
+                        break
+                else:
+                    yield (word, tuple(values[j] for j in letters))
+
+    # Expression (index) -> estimated rows of its table: the candidate words
+    # (lengths, literal start or end) times the rows of a sample of them
+    def _qat_estimate(self, index:int) -> float:
+        ids, words = self._qat_candidates(index)
+        if len(words) == 0:
+            return 0
+        step = max(len(words) // QAT_SAMPLE, 1)
+        sample = (ids[::step], words[::step])
+        rows = sum(1 for row in self._qat_rows(index, candidates=sample))
+        if step == 1: # every word: exact
+            return rows
+        return max(rows, 0.5) * len(words) / len(sample[1]) # none in the sample: less than one
+
+    # Expression (index), letters bound before it -> estimated rows per probe
+    # From all the rows (nothing bound) down to one (every letter bound)
+    def _qat_fanout(self, index:int, bound:set) -> float:
+        letters = self._qat_letters(index)
+        rows = self.qat_estimates[index]
+        if not letters or rows <= 1:
+            return rows
+        return rows ** (1 - sum(i in bound for i in letters) / len(letters))
+
+    # Join order from the depth on (the depths before it are kept):
+    # each time the expression with the fewest rows per probe, so that the
+    # bindings carried to the next depth stay the fewest
+    def _qat_order(self, depth:int = 0):
+        bound = set()
+        for index in self.qat_join[:depth]:
+            bound.update(self._qat_letters(index))
+        rest = [i for i in range(len(self.qat_exprs)) if i not in self.qat_join[:depth]]
+        del self.qat_join[depth:], self.qat_keys[depth:], self.qat_new[depth:]
+        del self.qat_lookup[depth:], self.qat_expected[depth:]
+
+        while rest:
+            index = min(rest, key=lambda x: self._qat_fanout(x, bound))
+            rest.remove(index)
+            letters = self._qat_letters(index)
+            self.qat_join.append(index)
+            self.qat_expected.append(self._qat_fanout(index, bound))
+            self.qat_keys.append([(ord(letters[j])-65, j) for j in range(len(letters)) if letters[j] in bound])
+            self.qat_new.append([(ord(letters[j])-65, j) for j in range(len(letters)) if letters[j] not in bound])
+            # look the rows up (see _qat_lookup) until as many words as the
+            # table has were read, then build the table; with nothing bound
+            # one probe reads them all
+            self.qat_lookup.append(len(self._qat_candidates(index)[0]))
+            bound.update(letters)
+
+    # Estimates of the expressions -> join order
+    def _qat_plan(self):
+        self.qat_estimates = [self._qat_estimate(i) for i in range(len(self.qat_exprs))]
+        self.qat_fanouts = [[0, 0] for i in self.qat_exprs] # probes, rows of every expression
+        self.qat_replanned = set() # expressions re-estimated from their probes
+        self.qat_replan = False
+        self.qat_join = []
+        self.qat_keys = [] # (letter, place in the row) bound before the depth: the key of its index
+        self.qat_new = [] # (letter, place in the row) bound by the depth
+        self.qat_lookup = [] # words left to look up before the table is built, 0: use the table
+        self.qat_expected = [] # estimated rows per probe
+        self.qat_index = {} # (expression, places of the key) -> key -> rows, see _qat_index
+        self._qat_order()
+
+    # Depth -> hash index of its table on the letters bound before it
+    # (kept by expression and letters: a new order can use it again)
+    def _qat_index(self, depth:int) -> dict:
+        index = self.qat_join[depth]
+        places = tuple(j for i, j in self.qat_keys[depth])
+        if (index, places) not in self.qat_index:
+            res = {}
+            if places == tuple(range(len(self._qat_letters(index)))): # every letter: the values are the key
+                for row in self._qat_rows(index):
+                    res.setdefault(row[1], []).append(row)
+            else:
+                for row in self._qat_rows(index):
+                    res.setdefault(tuple([row[1][j] for j in places]), []).append(row)
+            self.qat_index[(index, places)] = res
+        return self.qat_index[(index, places)]
+
+    # Depth, values of the letters bound before it -> its rows, looked up
+    # with those values (see _qat_rows) and kept for the next time they come back
+    def _qat_lookup(self, depth:int, key:tuple) -> list:
+        index = self.qat_join[depth]
+        memo = (index, tuple(i for i, j in self.qat_keys[depth]), key)
+        if memo in self.qat_memo:
+            self.stats["hits"] += 1
+            return self.qat_memo[memo]
+        self.stats["misses"] += 1
+
+        looked = self.stats["words"]
+        res = list(self._qat_rows(index, {chr(i+65): value for (i, j), value in zip(self.qat_keys[depth], key)}))
+        # once as many words as the table has were looked up, build the table
+        self.qat_lookup[depth] = max(self.qat_lookup[depth] - (self.stats["words"] - looked), 0)
+
+        if len(self.qat_memo) >= QAT_MEMO_SIZE: # the oldest go first
+            del self.qat_memo[next(iter(self.qat_memo))]
+        self.qat_memo[memo] = res
+        return res
+
+    # Depth, rows of one probe -> counted; a depth far above its estimate
+    # gets the measured rows as estimate, and the depths from it are ordered again
+    def _qat_measure(self, depth:int, rows:int):
+        index = self.qat_join[depth]
+        fanout = self.qat_fanouts[index]
+        fanout[0] += 1
+        fanout[1] += rows
+        if index in self.qat_replanned or fanout[0] < QAT_REPLAN_PROBES:
+            return
+        measured = fanout[1] / fanout[0]
+        if measured <= self.qat_expected[depth] * QAT_REPLAN:
+            return
+        self.qat_replanned.add(index)
+        letters = self._qat_letters(index)
+        share = len(self.qat_keys[depth]) / len(letters) if letters else 0
+        if share < 1: # back to rows of the whole table (see _qat_fanout)
+            self.qat_estimates[index] = max(measured, 1) ** (1 / (1 - share))
+            self.qat_replan = True
+
+    # QAT (dfs over the join order)
     def _qat(self, depth:int):
-        # if time() - self.qat_start_time > TIME_LIMIT: # timeout
-        #     self.qat_error = self._error("timeout")
-        #     self.stop = True
-        #     return
         if self.stop: # Stop
             return
         if depth == len(self.qat_exprs): # reach the end
@@ -618,152 +2042,60 @@ class JishoSearcher():
             if len(self.qat_answers) >= self.qat_num_limit:
                 self.stop = True
             return
-        
-        else:
-            exprssion = self.qat_exprs[depth]
-            if type(exprssion) == str: # normal expression
-                # Use optimized search candidates for QAT as well
-                search_candidates = dict
-                if hasattr(exprssion, '__len__') and isinstance(exprssion, str) and '.*' not in exprssion and '.' not in exprssion:
-                    target_length = len(exprssion)
-                    if target_length in dict_by_length:
-                        search_candidates = dict_by_length[target_length]
-                
-                if DEBUG and depth == 0: # show progress if debug
-                    iterate = tqdm.trange(len(search_candidates))
-                else:
-                    iterate = range(len(search_candidates))
-                    
-                for i in iterate: # iterate the dictionary
-                    if self._nfm(exprssion, search_candidates[i]) == True:
-                        self.qat_current_answer[depth][0] = search_candidates[i]
-                        self._qat(depth + 1)
-                    if self.stop:
-                        return
 
-            else: # has @ or QAT letters
-
-                # Substitute defined QAT letters
-                # Find undefined letters
-                expr, format = exprssion[1][:], exprssion[2][:]  # Shallow copy instead of deep copy
-                undefined = []
-                for i in range(len(expr)): # Substitute
-                    if expr[i][0] in ULETTER: # QAT letter
-                        if self.qat_current_letters[ord(expr[i][0])-65] != "": # Defined
-                            
-                            if len(expr[i]) == 2: # have voice or semi-voice
-                                if expr[i][-1] == '"': # voice
-                                    expr[i] = self._voice(self.qat_current_letters[ord(expr[i][0])-65])
-                                    if expr[i] == "#": # ERROR 
-                                        return
-                                    
-                                elif expr[i][-1] == '\'': # semi-voice
-                                    expr[i] = self._semi_voice(self.qat_current_letters[ord(expr[i][0])-65])
-                                    if expr[i] == "#": # ERROR
-                                        return
-                                    
-                            else: # not voice or semi-voice
-                                expr[i] = self.qat_current_letters[ord(expr[i][0])-65]
-                                
-                            format[i] = len(expr[i])
-                                    
-                        else: # Not defined
-                            undefined.append(i)
-
-                
-                if DEBUG and depth == 0: # show progress if debug
-                    iterate = tqdm.trange(len(dict))
-                else:
-                    iterate = range(len(dict))
-                    
-                for i in iterate:
-                    word = dict[i]
-                    
-                    split = self._splitter(word, format)
-                    if split == []:
-                        continue
-
-                    self.qat_current_answer[depth][0] = word
-
-                    for case in split:
-                        # Build new expr
-                        valid = True
-                        expr_new = expr[:]  # Shallow copy
-                        defined = []
-                        defined_val = []
-                        for i in range(len(expr)):
-                            if expr[i][0] in ULETTER or expr[i] == "@":
-                                if expr[i] == "@":
-                                    valid = valid and self._indict(case[i])
-                                    
-                                elif expr_new[i][0] in defined:
-                                    compare_string = defined_val[defined.index(expr_new[i][0])]
-                                    
-                                    if expr_new[i][-1] == '"': # voice
-                                        compare_string = self._voice(compare_string)
-                                        if compare_string == "#": # Error
-                                            valid = False
-                                    elif expr_new[i][-1] == '\'': # semi-voice
-                                        compare_string = self._semi_voice(compare_string)
-                                        if compare_string == "#": # Error
-                                            valid = False
-                                            
-                                    if case[i] != compare_string:
-                                        valid = False
-
-                                elif i in undefined:
-                                    defined.append(expr_new[i][0])
-                                    
-                                    if expr_new[i][-1] == '"': # un-voice
-                                        defined_val.append(self._un_voice(case[i]))
-                                        if defined_val[-1] == '#': # ERROR
-                                            valid = False # No need to pop the defined_val
-                                            
-                                    elif expr_new[i][-1] == '\'': # un-semi-voice
-                                        defined_val.append(self._un_semi_voice(case[i]))
-                                        if defined_val[-1] == '#': # ERROR
-                                            valid = False
-                                            
-                                    else:
-                                        defined_val.append(case[i])
-                                
-                                if valid == False:
-                                    break
-
-                                expr_new[i] = case[i]
-
-                        if not valid:
-                            continue
-
-                        if self._nfm("".join(expr_new), word) == True: # Match
-                            # Update current letters
-                            for i in undefined:
-                                if expr[i][-1] == '"': # voice
-                                    self.qat_current_letters[ord(expr[i][0])-65] = self._un_voice(expr_new[i])
-                                elif expr[i][-1] == '\'': # semi-voice
-                                    self.qat_current_letters[ord(expr[i][0])-65] = self._un_semi_voice(expr_new[i])
-                                else:
-                                    self.qat_current_letters[ord(expr[i][0])-65] = expr_new[i]
-
-                            self._qat(depth + 1)
-
-                            # Rollback current letters
-                            for i in undefined:
-                                self.qat_current_letters[ord(expr[i][0])-65] = ""
-                        
-                    if self.stop:
-                        return
-                    
+        letters = self.qat_current_letters
+        index = self.qat_join[depth]
+        answer = self.qat_current_answer[index]
+        new = self.qat_new[depth]
+        stream = depth == 0 or not self.qat_keys[depth] and self.qat_lookup[depth] > 0
+        if stream: # read as it is made: the first table, or the first probe of one with nothing bound
+            if depth > 0: # read again on the next probe: build the table then
+                self.qat_lookup[depth] = 0
+            rows = self._qat_rows(index, progress=depth == 0)
+        elif self.qat_lookup[depth] > 0: # only the rows with the bound letters
+            rows = self._qat_lookup(depth, tuple(letters[i] for i, j in self.qat_keys[depth]))
+        else:
+            rows = self._qat_index(depth).get(tuple(letters[i] for i, j in self.qat_keys[depth]), ())
+        if depth == 0:
+            self.qat_fanouts[index][0] = 1
+        elif not stream:
+            self._qat_measure(depth, len(rows))
+        for word, values in rows:
+            if depth == 0:
+                self.qat_fanouts[index][1] += 1
+            answer[0] = word
+            for i, j in new:
+                letters[i] = values[j]
+            self._qat(depth + 1)
+            if self.stop:
+                return
+            if self.qat_replan: # the depths after this one are done: order them again
+                self.qat_replan = False
+                self._qat_order(depth + 1)
+
+        # Rollback current letters
+        for i, j in new:
+            letters[i] = ""
+
+    # Join order and rows per probe, one depth per line:
+    # estimated, and after a search the measured ones
+    def _qat_report(self) -> list:
+        res = []
+        for depth in range(len(self.qat_join)):
+            index = self.qat_join[depth]
+            probes, rows = self.qat_fanouts[index]
+            line = f"{'  ' * depth}{self.qat_texts[index]}  (rows per probe {self.qat_expected[depth]:.1f}"
+            if probes:
+                line += f", measured {rows / probes:.1f} over {probes} probes"
+            res.append(line + ")")
+        return res
 
     #%% Search (Main Processing)
 
     # Search
     def search(self, expr: str, num: int = 200) -> str:
-        # Check cache first
-        cache_key = (expr, num)
-        if cache_key in self._result_cache:
-            return self._result_cache[cache_key]
-            
+        # words looked at, rejected by the kana prefilter; QAT lookups kept or redone (see _qat_lookup)
+        self.stats = {"words": 0, "rejected": 0, "hits": 0, "misses": 0}
         self._setup_qat()
         # Empty
         if expr == "":
@@ -772,36 +2104,76 @@ class JishoSearcher():
         expr = self._normalize(expr)
         if expr[0] == '#': # ERR
             return expr
+        expr = self._canonical(expr)
+
+        # Check cache first: equivalent queries share the canonical form
+        cache_key = (expr, num)
+        if cache_key in self._result_cache:
+            return self._result_cache[cache_key]
         
         qat_chance = sum([i in ULETTER.union(';') for i in expr])
 
         # Process
         # - Normal
         if not qat_chance:
-            expr_re = self._process_normal(expr)
-            if DEBUG:
-                print(f"Regex expression normal:{expr_re}")
-            if expr_re[0] == "#": # Error
-                return expr_re
+            prepared = self._prepare(expr)
+            if type(prepared) == str: # Error
+                return prepared
+            expr_re, plan, match, self.leaf_matchers = prepared
+            scan = self._compile_scan(plan)
+            candidates = self._candidates(plan)
+            shapes = self._matrix_shapes(plan)
+            low, high = self._length_range(plan)
+            if candidates != None and self._range_bits(low, high) != None:
+                candidates &= self._range_bits(low, high)
             
             res = []
             res_len = 0
             start_time = time()
+            self.start_time = start_time
+            self.timeout = False
             
-            # Use optimized search based on pattern characteristics
-            search_candidates = dict  # Default: search all
+            # Only the words of the lengths the expression allows
+            search_candidates = self._range_ids(low, high)
             
-            # If we can determine a fixed length, use length index
-            if hasattr(expr_re, '__len__') and isinstance(expr_re, str) and '.*' not in expr_re and '.' not in expr_re:
-                # Simple string match - exact length
-                target_length = len(expr_re)
-                if target_length in dict_by_length:
-                    search_candidates = dict_by_length[target_length]
+            # Few words left by the indices: only confirm those
+            if candidates != None and (scan == None or candidates.bit_count() * INDEX_RATIO < len(self.corpus.words)):
+                search_candidates = bit_ids(candidates)
+
+            elif scan == None and type(plan) == list and plan[0] in ('&', '|', '!'):
+                # Global &, |, !: every branch to a bitset, then AND / OR / NOT
+                ids = bit_ids(self._bits(plan))
+                if num > 0:
+                    ids = islice(ids, num)
+                res = list(map(self.corpus.words.__getitem__, ids))
+                if self.timeout:
+                    return self._error("timeout")
+                self._result_cache[cache_key] = res
+                return res
+
+            elif shapes != None: # Kana classes: all words at once with numpy
+                res = self._matrix_search(shapes, num)
+                self._result_cache[cache_key] = res
+                return res
+
+            elif scan != None: # Plain regex: scan the whole text at once
+                res = self._scan(scan, num, self._lengths(low, high))
+                if type(res) == list:
+                    self._result_cache[cache_key] = res
+                return res
             
+            # Words without one of the required kana are rejected before the regex
+            words = self.corpus.words
+            masks = self.corpus.masks
+            must = self.corpus.kana_mask(self._must(plan))
+
             for i in search_candidates: # Search
-                if self._nfm(expr_re, i) == True: # Match
+                self.stats["words"] += 1
+                if masks[i] & must != must: # a kana is missing
+                    self.stats["rejected"] += 1
+                elif match(words[i], i): # Match
                     res_len += 1
-                    res.append(i)
+                    res.append(words[i])
                     if res_len == num:
                         break
 
@@ -814,80 +2186,13 @@ class JishoSearcher():
         
         # - QAT QAQ
         else:
-            # Reject <>
-            if "<" in expr or ">" in expr:
-                return self._error("syntax", ex="< or > in QAT")
-            
             self.qat_num_limit = num
-
-            exprs = expr.split(";")
-
-            self.qat_letters = [0 for i in range(26)]
-
-            for i in range(len(exprs)-1, -1, -1):
-                if exprs[i] == "": # Delete Empty Expressions
-                    del exprs[i]
-                else:
-                    while exprs[i][0] == '(' and exprs[i][-1] == ')': # Remove unnecessary ()
-                        exprs[i] = exprs[i][1:-1]
-                    # Register Existed Letters
-                    # 0 : not exist, -1 : exist
-                    for j in range(26):
-                        if chr(j+65) in exprs[i]:
-                            self.qat_letters[j] = -1
-
-            if exprs == []: # check if empty
-                return self._error("empty")
-
-            # Find Length Limitation - optimized
-            for i in range(len(exprs) - 1, -1, -1):
-                if '=' in exprs[i]:  # Fixed Length
-                    condition = exprs[i].split('=')
-                    # Validate format more efficiently
-                    if (len(condition) != 2 or not condition[1].isdigit() or 
-                        len(condition[0]) != 3 or not condition[0].startswith('|') or 
-                        not condition[0].endswith('|')):
-                        return self._error("syntax", ex=exprs[i])
-                    
-                    letter_idx = ord(condition[0][1]) - ord('A')
-                    length_val = int(condition[1])
-                    
-                    # Check validity
-                    if not (0 <= letter_idx < 26) or not (0 < length_val < 10):
-                        return self._error("syntax", ex=exprs[i])
-
-                    if self.qat_letters[letter_idx] != -1:  # already defined
-                        return self._error("syntax", ex=exprs[i])
-
-                    self.qat_letters[letter_idx] = length_val
-                    del exprs[i]  # Remove the expression
-            
-            if exprs == []: # check if empty
-                return self._error("empty")
-            
-            # reject global &|! - optimized check
-            for expr in exprs:
-                bracket_level = 0
-                for char in expr:
-                    if char in '([':
-                        bracket_level += 1
-                    elif char in ')]':
-                        bracket_level -= 1
-                    elif bracket_level == 0 and char in '&|!':
-                        return self._error("syntax", ex=expr)
-            
-            # Sort expressions by number of uppercase letters (most first)
-            qat_order = [i for i in range(len(exprs))]
-            qat_order.sort(key=lambda x: sum(c.isupper() and c.isalpha() for c in exprs[x]), reverse=True)
-            exprs.sort(key=lambda x: sum(c.isupper() and c.isalpha() for c in x), reverse=True)
-
-            self.qat_exprs = [self._process_qat(i) for i in exprs]
-            self.qat_current_answer = [['', qat_order[i]] for i in range(len(exprs))]
-
-            for i in self.qat_exprs:
-                if i[0] == "#": # Error
-                    return i
+            error = self._prepare_qat(expr)
+            if error != None:
+                return error
+            self.qat_current_answer = [['', i] for i in range(len(self.qat_exprs))]
             
+            self._qat_plan()
             self._qat(0)
 
             if self.qat_error[0] == "#": # Error
@@ -909,6 +2214,13 @@ class JishoSearcher():
         elapsed = time() - start_time
         print(f"Expr:{expr}")
         print(f"Found {len(res)} items in {elapsed:.2f} seconds:")
+        if self.stats["words"]:
+            print(f"Prefilter: {self.stats['rejected']} of {self.stats['words']} words rejected ({self.stats['rejected'] / self.stats['words']:.1%})")
+        if self.stats["hits"] + self.stats["misses"]:
+            print(f"QAT lookups: {self.stats['hits']} kept, {self.stats['misses']} done")
+        if self.qat_join:
+            print("QAT order:")
+            print("\n".join(self._qat_report()))
         print()
 
         if not res:
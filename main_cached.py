@@ -1,10 +1,14 @@
 from constants import *
+from corpus import Corpus, default_corpus
 
 class JishoSearcher():
     #%% Initialization & Other Functions
-    def  __init__(self, lang: str = "en"):
+    # corpus: dictionary to search (shared default one if not given)
+    def  __init__(self, lang: str = "en", corpus: Corpus = None):
         # Language Setup
         self.lang = lang
+        # Dictionary, loaded on first search
+        self.corpus = corpus if corpus != None else default_corpus()
         # Cache for compiled patterns and results
         self._pattern_cache = {}
         self._result_cache = {}
@@ -12,7 +16,7 @@ class JishoSearcher():
 
     # Raise an error message
     def _error(self, text:str, ex:str="") -> str: # ex: explain
-        res = "#" + config[self.lang][text]
+        res = "#" + config()[self.lang][text]
         res += ":" + ex
 
         return res
@@ -116,7 +120,7 @@ class JishoSearcher():
         
     # Whether the expression is in the dictionary
     def _indict(self, expr: str) -> bool:
-        return hash(expr) in hasht
+        return expr in self.corpus.word_ids
     
     # Permutation of the expression (for <...>) - optimized version
     def _permutation(self, expr: str):
@@ -625,11 +629,11 @@ class JishoSearcher():
             exprssion = self.qat_exprs[depth]
             if type(exprssion) == str: # normal expression
                 # Use optimized search candidates for QAT as well
-                search_candidates = dict
+                search_candidates = self.corpus.words
                 if hasattr(exprssion, '__len__') and isinstance(exprssion, str) and '.*' not in exprssion and '.' not in exprssion:
                     target_length = len(exprssion)
-                    if target_length in dict_by_length:
-                        search_candidates = dict_by_length[target_length]
+                    if target_length in self.corpus.by_length:
+                        search_candidates = self.corpus.by_length[target_length]
                 
                 if DEBUG and depth == 0: # show progress if debug
                     iterate = tqdm.trange(len(search_candidates))
@@ -673,13 +677,14 @@ class JishoSearcher():
                             undefined.append(i)
 
                 
+                words = self.corpus.words
                 if DEBUG and depth == 0: # show progress if debug
-                    iterate = tqdm.trange(len(dict))
+                    iterate = tqdm.trange(len(words))
                 else:
-                    iterate = range(len(dict))
+                    iterate = range(len(words))
                     
                 for i in iterate:
-                    word = dict[i]
+                    word = words[i]
                     
                     split = self._splitter(word, format)
                     if split == []:
@@ -791,14 +796,14 @@ class JishoSearcher():
             start_time = time()
             
             # Use optimized search based on pattern characteristics
-            search_candidates = dict  # Default: search all
+            search_candidates = self.corpus.words  # Default: search all
             
             # If we can determine a fixed length, use length index
             if hasattr(expr_re, '__len__') and isinstance(expr_re, str) and '.*' not in expr_re and '.' not in expr_re:
                 # Simple string match - exact length
                 target_length = len(expr_re)
-                if target_length in dict_by_length:
-                    search_candidates = dict_by_length[target_length]
+                if target_length in self.corpus.by_length:
+                    search_candidates = self.corpus.by_length[target_length]
             
             for i in search_candidates: # Search
                 if self._nfm(expr_re, i) == True: # Match
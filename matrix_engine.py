@@ -0,0 +1,128 @@
+try:
+    import numpy as np
+except ImportError: # optional, the regex path is used without it
+    np = None
+
+# Bounded shapes with at most this many choices of counts are evaluated
+# as that many fixed shapes
+EXPAND_LIMIT = 16
+
+# NumPy engine over the kana matrix of a corpus
+# A leaf shape (see JishoSearcher._shape) is a list of kana classes, each
+# repeated min..max times. Instead of one regex call per word, every word
+# is checked at once, position by position, with boolean masks.
+# The result is exactly the set of words the regex fullmatches.
+class MatrixEngine():
+    def __init__(self, corpus):
+        self.corpus = corpus
+        # views of the artifact, no copy
+        self.matrix = np.frombuffer(corpus.matrix, dtype=np.uint8).reshape(-1, corpus.width)
+        self.lengths = np.frombuffer(corpus.lengths, dtype=np.uint8)
+        # position-major copy: one contiguous row of codes per position
+        self.columns = np.ascontiguousarray(self.matrix.T)
+
+    # Whether numpy is installed
+    @staticmethod
+    def available() -> bool:
+        return np != None
+
+    # Shape -> kind of shape the engine evaluates, or None (use the regex path)
+    # "fixed":   every class has a fixed count        ?[kgt]??, *{3}[k]
+    # "bounded": every class has a maximum count      *{1-3}[aep]
+    # unparsed regex (None) and unbounded * are not supported
+    def supports(self, shape):
+        if shape == None:
+            return None
+        if all(low == high for kana, low, high in shape):
+            return "fixed"
+        if all(high != None for kana, low, high in shape):
+            return "bounded"
+        return None
+
+    # kana (None for any) -> boolean table indexed by code
+    def _table(self, kana):
+        table = np.zeros(256, dtype=bool)
+        if kana == None:
+            table[1:] = True # 0 is past the end of the word
+        else:
+            codes = self.corpus.codes
+            table[[codes[c] for c in kana if c in codes]] = True
+        return table
+
+    # Fixed shape: one length, one class per position
+    def _mask_fixed(self, shape):
+        positions = []
+        for kana, low, high in shape:
+            positions += [kana] * low
+
+        res = self.lengths == len(positions)
+        if len(positions) > len(self.columns):
+            return res
+        for position, kana in enumerate(positions):
+            if kana != None:
+                res &= self._table(kana)[self.columns[position]]
+        return res
+
+    # Bounded shape
+    # reach[q, w]: the first q kana of word w can be cut among the classes seen so far
+    def _mask_bounded(self, shape):
+        width, count = self.columns.shape
+        reach = np.zeros((width + 1, count), dtype=bool)
+        reach[0] = True
+
+        for kana, low, high in shape:
+            ok = self._table(kana)[self.columns]
+            high = width if high == None else min(high, width)
+
+            res = np.zeros_like(reach)
+            run = reach # this class took c kana
+            for c in range(high + 1):
+                if c >= low:
+                    res |= run
+                if c == high:
+                    break
+                longer = np.zeros_like(run)
+                longer[1:] = run[:-1] & ok
+                run = longer
+                if not run.any():
+                    break
+            reach = res
+
+        return reach[self.lengths, np.arange(count)]
+
+    # Bounded shape -> the fixed shapes it stands for (one per choice of
+    # counts, no longer than the longest word), None if there are more than limit
+    def _expand(self, shape, limit:int):
+        width = len(self.columns)
+        res = [[]]
+        for kana, low, high in shape:
+            res = [i + [(kana, c, c)] for i in res for c in range(low, high + 1)
+                   if sum(j[1] for j in i) + c <= width]
+            if len(res) > limit:
+                return None
+        return res
+
+    # Shape -> boolean mask over the words
+    # A bounded shape with few choices of counts is cheaper as a few fixed shapes
+    def mask(self, shape):
+        if self.supports(shape) == "fixed":
+            return self._mask_fixed(shape)
+
+        expanded = self._expand(shape, EXPAND_LIMIT)
+        if expanded == None:
+            return self._mask_bounded(shape)
+        res = np.zeros(self.lengths.shape, dtype=bool)
+        for i in expanded:
+            res |= self._mask_fixed(i)
+        return res
+
+    # Several shapes (| of leaves) -> ids of the words matching any of them,
+    # in dictionary order, at most num (num <= 0: all)
+    def search(self, shapes:list, num:int):
+        res = np.zeros(self.lengths.shape, dtype=bool)
+        for shape in shapes:
+            res |= self.mask(shape)
+        ids = np.flatnonzero(res)
+        if num > 0:
+            ids = ids[:num]
+        return ids.tolist()
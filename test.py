@@ -15,4 +15,9 @@ def test():
     # test.search_print("ACB;CAB;ACAB;ABC\";|A|=1;|B|=1;|C|=1") 
     # test.search_print("づり?い")
     # test.search_print("AB\";A\"B\";|B|=1")
+    # QAT with an @ expression without letters
+    # test.search_print("A;そと@", num=5)
+    # test.search_print("A;?@", num=5)
+    # test.search_print("AB;?@そ;|A|=1", num=5)
+    # print(test.explain("A;?@")) # the order search_print showed
 test()
\ No newline at end of file